@@ -0,0 +1,156 @@
+# Approximate nearest-neighbour search over the CLIP photo features with an inverted file (IVF) index.
+# The features are clustered offline with spherical k-means; each photo is stored in the inverted
+# list of its closest centroid. A query only scores the photos of its `nprobe` closest lists, so
+# nprobe is the recall/latency knob: nprobe == n_lists is the exact search.
+import time
+from pathlib import Path
+
+import numpy as np
+
+from topk_scorer import blockwise_topk, select_topk, DEFAULT_BLOCK_SIZE
+
+INDEX_FILE_NAME = "ivf_index.npz"
+
+
+def index_path(features_file):
+    """The index is saved next to the features it was built from"""
+    return Path(features_file).with_name(INDEX_FILE_NAME)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _assign(features, centroids, block_size):
+    # Closest centroid (highest inner product) of every row, computed block by block
+    assignments = np.empty(features.shape[0], dtype=np.int64)
+    for start in range(0, features.shape[0], block_size):
+        block = np.asarray(features[start:start + block_size], dtype=np.float32)
+        assignments[start:start + len(block)] = (block @ centroids.T).argmax(axis=1)
+    return assignments
+
+
+class IVFIndex:
+    def __init__(self, centroids, list_offsets, list_ids, nprobe=8):
+        self.centroids = centroids
+        # Photos of list i are list_ids[list_offsets[i]:list_offsets[i + 1]]
+        self.list_offsets = list_offsets
+        self.list_ids = list_ids
+        self.nprobe = nprobe
+
+    @property
+    def n_lists(self):
+        return self.centroids.shape[0]
+
+    @classmethod
+    def build(cls, features, n_lists=None, iterations=10, sample_size=100000, seed=0,
+              block_size=DEFAULT_BLOCK_SIZE, nprobe=8):
+        total = features.shape[0]
+        if n_lists is None:
+            # Usual IVF rule of thumb: about 4 * sqrt(N) lists
+            n_lists = max(1, int(4 * np.sqrt(total)))
+        n_lists = min(n_lists, total)
+        rng = np.random.default_rng(seed)
+
+        # Train the centroids on a sample, the full corpus is only read for the final assignment
+        sample_idx = np.sort(rng.choice(total, size=min(sample_size, total), replace=False))
+        sample = np.asarray(features[sample_idx], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+        for iteration in range(iterations):
+            assignments = _assign(sample, centroids, block_size)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=n_lists)
+            # Empty lists are re-seeded with a random sample point
+            empty = np.flatnonzero(counts == 0)
+            sums[empty] = sample[rng.choice(len(sample), size=len(empty))]
+            centroids = _normalize(sums)
+            print(f"IVF training iteration {iteration + 1}/{iterations}")
+
+        assignments = _assign(features, centroids, block_size)
+        # Group the photo indices by list; a stable sort keeps each list in corpus order
+        list_ids = np.argsort(assignments, kind="stable").astype(np.int64)
+        counts = np.bincount(assignments, minlength=n_lists)
+        list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(centroids.astype(np.float32), list_offsets, list_ids, nprobe)
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    @classmethod
+    def load(cls, path, nprobe=8):
+        data = np.load(path)
+        return cls(data["centroids"], data["list_offsets"], data["list_ids"], nprobe)
+
+    def candidates(self, text_feature, nprobe):
+        # Photos of the nprobe lists closest to the query, sorted for sequential reads of the memmap
+        nprobe = min(nprobe, self.n_lists)
+        list_scores = self.centroids @ text_feature
+        probe = np.argpartition(-list_scores, nprobe - 1)[:nprobe]
+        ids = np.concatenate([self.list_ids[self.list_offsets[i]:self.list_offsets[i + 1]] for i in probe])
+        return np.sort(ids)
+
+    def search(self, photo_features, text_features, k, nprobe=None):
+        """Approximate top-k, same (indices, scores) layout as topk_scorer.blockwise_topk"""
+        nprobe = nprobe or self.nprobe
+        text_features = np.atleast_2d(np.asarray(text_features, dtype=np.float32))
+        all_indices, all_scores = [], []
+        for text_feature in text_features:
+            ids = self.candidates(text_feature, nprobe)
+            scores = np.asarray(photo_features[ids], dtype=np.float32) @ text_feature
+            scores, ids = select_topk(scores, ids, k)
+            all_indices.append(ids)
+            all_scores.append(scores)
+        # Rows can be shorter than k when the probed lists hold fewer photos; pad with -1
+        width = max([len(ids) for ids in all_indices] + [0])
+        indices = np.full((len(all_indices), width), -1, dtype=np.int64)
+        scores = np.full((len(all_scores), width), -np.inf, dtype=np.float32)
+        for q, (ids, row_scores) in enumerate(zip(all_indices, all_scores)):
+            indices[q, :len(ids)] = ids
+            scores[q, :len(row_scores)] = row_scores
+        return indices, scores
+
+
+def build_index(features_file, n_lists=None, iterations=10, nprobe=8):
+    """Build the IVF index of a features.npy and save it next to it"""
+    features = np.load(features_file, mmap_mode="r")
+    index = IVFIndex.build(features, n_lists=n_lists, iterations=iterations, nprobe=nprobe)
+    output_file = index_path(features_file)
+    index.save(output_file)
+    print(f"IVF index with {index.n_lists} lists saved to {output_file}")
+    return output_file
+
+
+def evaluate_recall(index, photo_features, text_features, k=10, nprobe_values=(1, 2, 4, 8, 16, 32)):
+    """recall@k and mean latency of the index against the exact scorer, for each nprobe"""
+    text_features = np.atleast_2d(np.asarray(text_features, dtype=np.float32))
+    exact, _ = blockwise_topk(photo_features, text_features, k)
+    report = []
+    for nprobe in nprobe_values:
+        start = time.perf_counter()
+        approx, _ = index.search(photo_features, text_features, k, nprobe=nprobe)
+        elapsed = time.perf_counter() - start
+        hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approx, exact))
+        report.append({
+            "nprobe": nprobe,
+            f"recall@{k}": hits / exact.size,
+            "latency_ms": 1000 * elapsed / len(text_features),
+        })
+    return report
+
+
+if __name__ == "__main__":
+    # Pick nprobe: python ann_index.py data/lite/features/features.npy
+    import sys
+
+    features_file = sys.argv[1] if len(sys.argv) > 1 else "data/lite/features/features.npy"
+    if not index_path(features_file).exists():
+        build_index(features_file)
+    photo_features = np.load(features_file, mmap_mode="r")
+    index = IVFIndex.load(index_path(features_file))
+    # Use a random sample of photo vectors as stand-in queries
+    rng = np.random.default_rng(0)
+    queries = np.asarray(photo_features[np.sort(rng.choice(len(photo_features), size=200, replace=False))])
+    for row in evaluate_recall(index, photo_features, queries):
+        print(row)
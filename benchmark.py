@@ -0,0 +1,264 @@
+# Reproducible benchmarks for search, ingest, merge and rerank, on synthetic data only:
+# no network, no GPU and no CLIP weights are needed. Every benchmark runs in its own process so its
+# peak RSS can be reported, and the results are printed (and optionally saved) as JSON so runs can
+# be compared across commits:
+#     python benchmark.py --scale lite --output bench_lite.json
+#     python benchmark.py --scale full --only search merge
+# Synthetic data is cached in --workdir and reused by later runs with the same scale and seed.
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SCALES = {"lite": 25000, "full": 2000000}
+BENCHMARKS = ("search", "ingest", "merge", "rerank")
+DIM = 512
+SYNTHETIC_IMAGES = 256
+QUERIES = 200
+VERSION = "bench"
+
+
+def _percentiles(latencies):
+    latencies = np.asarray(latencies)
+    return {
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "qps": float(len(latencies) / latencies.sum()),
+    }
+
+
+def _random_unit_vectors(rng, count, dim=DIM):
+    vectors = rng.standard_normal((count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def prepare_data(workdir, scale, seed=0):
+    """Synthetic features.npy, photo_ids.csv and JPEG folder under workdir/<scale>/"""
+    from PIL import Image
+
+    root = Path(workdir) / scale
+    features_path = root / VERSION / "features"
+    photos_path = root / VERSION / "photos"
+    features_file = features_path / "features.npy"
+    photo_ids_file = features_path / "photo_ids.csv"
+    total = SCALES[scale]
+    rng = np.random.default_rng(seed)
+    if not features_file.exists():
+        print(f"Generating {total} synthetic feature vectors in {features_path}")
+        features_path.mkdir(parents=True, exist_ok=True)
+        features = np.lib.format.open_memmap(features_path / "features.tmp.npy", mode="w+",
+                                             dtype=np.float16, shape=(total, DIM))
+        for start in range(0, total, 65536):
+            features[start:start + 65536] = _random_unit_vectors(rng, min(65536, total - start))
+        features.flush()
+        del features
+        pd.DataFrame({"photo_id": [f"synthetic{i:08d}" for i in range(total)],
+                      "description": ""}).to_csv(photo_ids_file, index=False)
+        os.replace(features_path / "features.tmp.npy", features_file)
+    if not photos_path.exists():
+        print(f"Generating {SYNTHETIC_IMAGES} synthetic photos in {photos_path}")
+        photos_path.mkdir(parents=True)
+        for i in range(SYNTHETIC_IMAGES):
+            pixels = rng.integers(0, 256, size=(427, 640, 3), dtype=np.uint8)
+            Image.fromarray(pixels).save(photos_path / f"synthetic{i:08d}.jpg", quality=85)
+    return root, photo_ids_file, features_file
+
+
+def bench_search(root, photo_ids_file, features_file, k=10):
+    from model_image_search import SearchEngine
+
+    rng = np.random.default_rng(1)
+    queries = [f"synthetic query {i}" for i in range(QUERIES)]
+    embeddings = _random_unit_vectors(rng, QUERIES)
+    results = {}
+    for variant, options in (("exact", {}), ("exact-resident", {"resident_features": True}),
+                             ("ivf", {"use_index": True}), ("int8", {"quantization": "int8"})):
+        if variant == "ivf":
+            from ann_index import build_index, index_path
+            if not index_path(features_file).exists():
+                build_index(features_file)
+        if variant == "int8":
+            from quantization import build_codes, codes_path
+            if not codes_path(features_file, "int8").exists():
+                build_codes(features_file, "int8")
+        start = time.perf_counter()
+        engine = SearchEngine(photo_ids_file, features_file, **options)
+        load_s = time.perf_counter() - start
+        # Pre-seed the query cache, so search() runs its real path without loading CLIP
+        for query, embedding in zip(queries, embeddings):
+            engine.query_cache.put(engine.encoder_name, query, embedding)
+        engine.search(queries[0], k)
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            engine.search(query, k)
+            latencies.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        engine.search_batch(queries, k)
+        batch_s = time.perf_counter() - start
+        results[variant] = dict(_percentiles(latencies), engine_load_s=load_s, batch_qps=QUERIES / batch_s)
+    return results
+
+
+def bench_ingest(root, photo_ids_file, features_file, batch_size=32):
+    try:
+        import torch
+    except ImportError:
+        return {"skipped": "torch is not installed"}
+    import data_processor
+
+    # Stub encoder: the benchmark measures decode, preprocess, shard writing and merge, not CLIP
+    projection = torch.randn(3 * 8 * 8, DIM)
+
+    class StubModel:
+        def encode_image(self, images):
+            return torch.nn.functional.adaptive_avg_pool2d(images, 8).flatten(1) @ projection
+
+    def stub_preprocess(photo):
+        pixels = np.asarray(photo.convert("RGB").resize((224, 224)), dtype=np.float32) / 255
+        return torch.from_numpy(pixels).permute(2, 0, 1)
+
+    data_processor.set_model(StubModel(), stub_preprocess, "cpu")
+    ingest_path = root / "ingest"
+    features_path = ingest_path / VERSION / "features"
+    # Start from an empty index every run, with the synthetic photos
+    shutil.rmtree(features_path, ignore_errors=True)
+    (ingest_path / VERSION).mkdir(parents=True, exist_ok=True)
+    photos_link = ingest_path / VERSION / "photos"
+    if not photos_link.exists():
+        photos_link.symlink_to((root / VERSION / "photos").resolve())
+
+    start = time.perf_counter()
+    data_processor.process_data(None, ingest_path, version=VERSION, batch_size=batch_size, thumbnail_sizes=None)
+    elapsed = time.perf_counter() - start
+    return {"images": SYNTHETIC_IMAGES, "seconds": elapsed, "images_per_sec": SYNTHETIC_IMAGES / elapsed,
+            "encoder": "stub"}
+
+
+def bench_merge(root, photo_ids_file, features_file, shard_size=1024):
+    from data_processor import merge_shards
+    from index_manifest import IndexManifest
+
+    merge_path = root / "merge"
+    manifest_file = merge_path / "manifest.csv"
+    features = np.load(features_file, mmap_mode="r")
+    if not manifest_file.exists():
+        # Split the synthetic matrix into shards once; later runs only time the merge
+        manifest = IndexManifest(merge_path)
+        photo_ids = pd.read_csv(photo_ids_file)["photo_id"].tolist()
+        for shard, start in enumerate(range(0, len(features), shard_size)):
+            ids = photo_ids[start:start + shard_size]
+            shard_features_path, shard_ids_path = manifest.shard_files(shard)
+            np.save(shard_features_path, np.asarray(features[start:start + shard_size]))
+            pd.DataFrame({"photo_id": ids, "description": ""}).to_csv(shard_ids_path, index=False)
+            manifest.add_shard(shard, ids, [0.0] * len(ids))
+    manifest = IndexManifest(merge_path)
+    start = time.perf_counter()
+    merge_shards(manifest, merge_path / "features.npy", merge_path / "photo_ids.csv", progress_every=10 ** 9)
+    elapsed = time.perf_counter() - start
+    return {"photos": len(features), "shards": manifest.next_shard(), "seconds": elapsed,
+            "photos_per_sec": len(features) / elapsed}
+
+
+def bench_rerank(root, photo_ids_file, features_file, candidates=10, repeats=50):
+    import gemini_ranker
+
+    photo_ids = [f"synthetic{i:08d}" for i in range(SYNTHETIC_IMAGES)]
+    backend = gemini_ranker.StubBackend()
+    # First call also creates the rerank thumbnails
+    gemini_ranker.gemini_rank(photo_ids[:candidates], root, VERSION, "warm up", 4, backend=backend)
+    misses, hits = [], []
+    for i in range(repeats):
+        ids = photo_ids[(i * candidates) % (SYNTHETIC_IMAGES - candidates):][:candidates]
+        gemini_ranker.clear_rerank_cache()
+        start = time.perf_counter()
+        gemini_ranker.gemini_rank(ids, root, VERSION, f"query {i}", 4, backend=backend)
+        misses.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        gemini_ranker.gemini_rank(ids, root, VERSION, f"query {i}", 4, backend=backend)
+        hits.append(time.perf_counter() - start)
+    return {"cache_miss": _percentiles(misses), "cache_hit": _percentiles(hits), "backend": "stub"}
+
+
+def _peak_rss_mb():
+    # High-water mark of this process' RSS. Unlike ru_maxrss it is not inherited across fork/exec
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def _run_child(name, workdir, scale):
+    # Runs one benchmark in this (fresh) process and prints its JSON result as the last line
+    root, photo_ids_file, features_file = prepare_data(workdir, scale)
+    result = globals()[f"bench_{name}"](root, photo_ids_file, features_file)
+    result["peak_rss_mb"] = _peak_rss_mb()
+    print(json.dumps(result))
+
+
+def run_benchmark(name, workdir, scale):
+    """Run one benchmark in a child process; adds its wall time"""
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name,
+                             "--workdir", str(workdir), "--scale", scale],
+                            stdout=subprocess.PIPE, text=True)
+    if output.returncode != 0:
+        return {"error": f"exit status {output.returncode}", "output": output.stdout[-2000:]}
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    result["wall_s"] = time.perf_counter() - start
+    return result
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--scale", choices=sorted(SCALES), default="lite")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=list(BENCHMARKS))
+    parser.add_argument("--workdir", default="bench_data")
+    parser.add_argument("--output")
+    parser.add_argument("--child", choices=BENCHMARKS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _run_child(args.child, args.workdir, args.scale)
+        return
+
+    # Generate the data up front so its cost is not charged to the first benchmark
+    prepare_data(args.workdir, args.scale)
+    report = {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "scale": args.scale,
+        "photos": SCALES[args.scale],
+        "results": {},
+    }
+    for name in args.only:
+        print(f"Running {name} benchmark ({args.scale})", file=sys.stderr)
+        report["results"][name] = run_benchmark(name, args.workdir, args.scale)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
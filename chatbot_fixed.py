@@ -1,7 +1,4 @@
 import gradio as gr
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-import math
 import os
 from pathlib import Path
 import sys
@@ -11,15 +8,24 @@ import tempfile
 sys.path.append('.')
 
 try:
-    from data_downloader import download_data
-    from data_processor import process_data
-    from model_image_search import image_search
+    from ingest_pipeline import pipelined_ingest
+    from model_image_search import get_search_engine
+    from query_scheduler import get_scheduler
     from gemini_ranker import gemini_rank
+    from result_renderer import render_results
+    from metrics import format_breakdown, start_metrics_server, trace
     print("All modules imported successfully!")
 except ImportError as e:
     print(f"Import error: {e}")
     print("Please make sure all required modules are available")
 
+# Micro-batching of concurrent searches: queries arriving within SCHEDULER_MAX_WAIT seconds of
+# each other share one batch, up to SCHEDULER_MAX_BATCH_SIZE queries
+SCHEDULER_MAX_BATCH_SIZE = 32
+SCHEDULER_MAX_WAIT = 0.002
+# Chat events allowed to run at once; Gradio runs one at a time by default
+CONCURRENCY_LIMIT = 16
+
 class FixedRAGChatbot:
     def __init__(self):
         self.file_path = "data"
@@ -27,6 +33,8 @@ class FixedRAGChatbot:
         self.feature_file = f"{self.file_path}/{self.version}/features/features.npy"
         self.photo_ids_file = None
         self.photo_features_file = None
+        self.search_engine = None
+        self.scheduler = None
         self.initialized = False
         self.initialize_data()
     
@@ -35,14 +43,17 @@ class FixedRAGChatbot:
         try:
             if not Path(self.feature_file).exists():
                 print("Downloading and processing data...")
-                photo_metadata = download_data(version="lite", data_path="data", threads_count=16)
-                photo_ids_file, photo_features_file = process_data(photo_metadata, self.file_path, version="lite", batch_size=16)
+                photo_ids_file, photo_features_file = pipelined_ingest(self.file_path, version="lite", batch_size=16, threads_count=16)
                 self.photo_ids_file = photo_ids_file
                 self.photo_features_file = photo_features_file
             else:
                 self.photo_ids_file = "data/lite/features/photo_ids.csv"
                 self.photo_features_file = "data/lite/features/features.npy"
             
+            # Shared with every other caller using the same feature files
+            self.search_engine = get_search_engine(self.photo_ids_file, self.photo_features_file)
+            # Batches the searches of concurrent users into one encode and scoring pass
+            self.scheduler = get_scheduler(self.search_engine, SCHEDULER_MAX_BATCH_SIZE, SCHEDULER_MAX_WAIT)
             self.initialized = True
             print("Data initialized successfully!")
         except Exception as e:
@@ -56,9 +67,7 @@ class FixedRAGChatbot:
         
         try:
             # Search for images using CLIP
-            best_photo_ids_raw = image_search(
-                self.photo_ids_file, 
-                self.photo_features_file, 
+            best_photo_ids_raw = self.scheduler.search(
                 query, 
                 10  # results_count
             )
@@ -86,52 +95,14 @@ class FixedRAGChatbot:
             return [], [], error_msg
     
     def create_image_grid(self, best_photo_ids, image_ids, query):
-        """Create a grid of images and return the file path"""
+        """Create a grid of the reranked images, as an in-memory image"""
         if not best_photo_ids or not image_ids:
             return None
         
         try:
-            rows = 2
-            display_cols = math.ceil(len(image_ids) / rows)
-            
-            fig, axes = plt.subplots(rows, display_cols, figsize=(12, rows * 3))
-            
-            # Handle single image case
-            if len(image_ids) == 1:
-                axes = [axes]
-            elif rows == 1:
-                axes = axes.reshape(1, -1)
-            else:
-                axes = axes.flatten()
-            
-            for i, image_id in enumerate(image_ids):
-                if image_id <= len(best_photo_ids):
-                    photo_id = best_photo_ids[image_id - 1]
-                    photo_image_path = f"{self.file_path}/{self.version}/photos/{photo_id}.jpg"
-                    
-                    if os.path.exists(photo_image_path):
-                        img = mpimg.imread(photo_image_path)
-                        axes[i].imshow(img)
-                        axes[i].set_title(f"Photo ID: {photo_id}", fontsize=8)
-                        axes[i].axis("off")
-                    else:
-                        axes[i].text(0.5, 0.5, f"Image not found: {photo_id}", 
-                                   ha='center', va='center', transform=axes[i].transAxes)
-                        axes[i].axis("off")
-            
-            # Hide unused subplots
-            for i in range(len(image_ids), len(axes)):
-                axes[i].axis("off")
-            
-            plt.suptitle(f'Images found for: "{query}"', fontsize=16)
-            plt.tight_layout()
-            
-            # Save to temporary file
-            temp_file = f"search_results_{hash(query) % 10000}.png"
-            plt.savefig(temp_file, format='png', dpi=150, bbox_inches='tight')
-            plt.close()
-            
-            return temp_file
+            # Composited from the display thumbnails and cached by (query, photo IDs)
+            photo_ids = [best_photo_ids[image_id - 1] for image_id in image_ids if image_id <= len(best_photo_ids)]
+            return render_results(self.file_path, self.version, photo_ids, query)
             
         except Exception as e:
             print(f"Error creating image grid: {e}")
@@ -140,35 +111,33 @@ class FixedRAGChatbot:
     def chat(self, message, history):
         """Main chat function"""
         if not message.strip():
-            return "", history
+            return "", history, None, "Please enter a search query"
         
         # Add user message to history
         history.append({"role": "user", "content": message})
         
-        try:
-            # Search for images
-            best_photo_ids, image_ids, status_msg = self.search_images(message)
-            
-            if best_photo_ids and image_ids:
-                # Create image grid
-                image_file = self.create_image_grid(best_photo_ids, image_ids, message)
+        # Time of every stage of this query, shown in the status box
+        with trace() as stages:
+            image_grid = None
+            try:
+                # Search for images
+                best_photo_ids, image_ids, status_msg = self.search_images(message)
                 
-                if image_file and os.path.exists(image_file):
-                    response = f"{status_msg} Here are the images:"
-                    history.append({"role": "assistant", "content": response})
-                    return "", history, image_file
+                if best_photo_ids and image_ids:
+                    # Create image grid
+                    image_grid = self.create_image_grid(best_photo_ids, image_ids, message)
+                    
+                    if image_grid is not None:
+                        response = f"{status_msg} Here are the images:"
+                    else:
+                        response = f"{status_msg} But I couldn't display them. Please try again."
                 else:
-                    response = f"{status_msg} But I couldn't display them. Please try again."
-                    history.append({"role": "assistant", "content": response})
-                    return "", history, None
-            else:
-                history.append({"role": "assistant", "content": status_msg})
-                return "", history, None
-                
-        except Exception as e:
-            response = f"Sorry, I encountered an error: {str(e)}. Please try again."
-            history.append({"role": "assistant", "content": response})
-            return "", history, None
+                    response = status_msg
+                    
+            except Exception as e:
+                response = f"Sorry, I encountered an error: {str(e)}. Please try again."
+        history.append({"role": "assistant", "content": response})
+        return "", history, image_grid, f"Last query: {format_breakdown(stages)}"
 
 def create_chatbot_interface():
     """Create the Gradio interface"""
@@ -221,8 +190,8 @@ def create_chatbot_interface():
             return [], None
         
         # Connect events
-        msg.submit(user_input, [msg, chatbot_interface], [msg, chatbot_interface, image_output])
-        submit_btn.click(user_input, [msg, chatbot_interface], [msg, chatbot_interface, image_output])
+        msg.submit(user_input, [msg, chatbot_interface], [msg, chatbot_interface, image_output, status_text])
+        submit_btn.click(user_input, [msg, chatbot_interface], [msg, chatbot_interface, image_output, status_text])
         clear_btn.click(clear_chat, outputs=[chatbot_interface, image_output])
         
         # Example queries
@@ -242,5 +211,8 @@ def create_chatbot_interface():
     return demo
 
 if __name__ == "__main__":
+    # Prometheus scrape endpoint for the per-stage latency histograms
+    start_metrics_server(int(os.environ.get("METRICS_PORT", 9100)))
     demo = create_chatbot_interface()
+    demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT)
     demo.launch(share=False, server_name="0.0.0.0", server_port=7861) 
\ No newline at end of file
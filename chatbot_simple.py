@@ -1,8 +1,4 @@
 import gradio as gr
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
-import math
-import os
 from pathlib import Path
 import sys
 import tempfile
@@ -11,10 +7,10 @@ import tempfile
 sys.path.append('.')
 
 try:
-    from data_downloader import download_data
-    from data_processor import process_data
-    from model_image_search import image_search
+    from ingest_pipeline import pipelined_ingest
+    from model_image_search import get_search_engine
     from gemini_ranker import gemini_rank
+    from result_renderer import render_results
     print("All modules imported successfully!")
 except ImportError as e:
     print(f"Import error: {e}")
@@ -27,6 +23,7 @@ class SimpleRAGChatbot:
         self.feature_file = f"{self.file_path}/{self.version}/features/features.npy"
         self.photo_ids_file = None
         self.photo_features_file = None
+        self.search_engine = None
         self.initialized = False
         self.initialize_data()
     
@@ -35,14 +32,15 @@ class SimpleRAGChatbot:
         try:
             if not Path(self.feature_file).exists():
                 print("Downloading and processing data...")
-                photo_metadata = download_data(version="lite", data_path="data", threads_count=16)
-                photo_ids_file, photo_features_file = process_data(photo_metadata, self.file_path, version="lite", batch_size=16)
+                photo_ids_file, photo_features_file = pipelined_ingest(self.file_path, version="lite", batch_size=16, threads_count=16)
                 self.photo_ids_file = photo_ids_file
                 self.photo_features_file = photo_features_file
             else:
                 self.photo_ids_file = "data/lite/features/photo_ids.csv"
                 self.photo_features_file = "data/lite/features/features.npy"
             
+            # Shared with every other caller using the same feature files
+            self.search_engine = get_search_engine(self.photo_ids_file, self.photo_features_file)
             self.initialized = True
             print("Data initialized successfully!")
         except Exception as e:
@@ -56,9 +54,7 @@ class SimpleRAGChatbot:
         
         try:
             # Search for images using CLIP
-            best_photo_ids_raw = image_search(
-                self.photo_ids_file, 
-                self.photo_features_file, 
+            best_photo_ids_raw = self.search_engine.search(
                 query, 
                 10  # results_count
             )
@@ -91,47 +87,9 @@ class SimpleRAGChatbot:
             return None
         
         try:
-            rows = 2
-            display_cols = math.ceil(len(image_ids) / rows)
-            
-            fig, axes = plt.subplots(rows, display_cols, figsize=(12, rows * 3))
-            
-            # Handle single image case
-            if len(image_ids) == 1:
-                axes = [axes]
-            elif rows == 1:
-                axes = axes.reshape(1, -1)
-            else:
-                axes = axes.flatten()
-            
-            for i, image_id in enumerate(image_ids):
-                if image_id <= len(best_photo_ids):
-                    photo_id = best_photo_ids[image_id - 1]
-                    photo_image_path = f"{self.file_path}/{self.version}/photos/{photo_id}.jpg"
-                    
-                    if os.path.exists(photo_image_path):
-                        img = mpimg.imread(photo_image_path)
-                        axes[i].imshow(img)
-                        axes[i].set_title(f"Photo ID: {photo_id}", fontsize=8)
-                        axes[i].axis("off")
-                    else:
-                        axes[i].text(0.5, 0.5, f"Image not found: {photo_id}", 
-                                   ha='center', va='center', transform=axes[i].transAxes)
-                        axes[i].axis("off")
-            
-            # Hide unused subplots
-            for i in range(len(image_ids), len(axes)):
-                axes[i].axis("off")
-            
-            plt.suptitle(f'Images found for: "{query}"', fontsize=16)
-            plt.tight_layout()
-            
-            # Save to temporary file instead of base64
-            temp_file = f"temp_search_results_{hash(query) % 10000}.png"
-            plt.savefig(temp_file, format='png', dpi=150, bbox_inches='tight')
-            plt.close()
-            
-            return temp_file
+            # Composited from the display thumbnails and cached by (query, photo IDs)
+            photo_ids = [best_photo_ids[image_id - 1] for image_id in image_ids if image_id <= len(best_photo_ids)]
+            return render_results(self.file_path, self.version, photo_ids, query)
             
         except Exception as e:
             print(f"Error creating image grid: {e}")
@@ -153,7 +111,7 @@ class SimpleRAGChatbot:
                 # Create image grid
                 image_grid = self.display_images(best_photo_ids, image_ids, message)
                 
-                if image_grid:
+                if image_grid is not None:
                     response = f"{status_msg} Here are the images:"
                     history.append({"role": "assistant", "content": response})
                     return "", history, image_grid
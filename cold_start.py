@@ -0,0 +1,59 @@
+# Cold-start regression metric: how long a brand-new process takes to answer one query when the
+# features already exist. Each run starts a fresh interpreter so nothing is warm except the OS
+# page cache, and reports the time spent in each stage as JSON:
+#     python cold_start.py [photo_ids.csv] [features.npy] [budget_seconds]
+# The exit status is 1 when the median total exceeds the budget, so CI can track it.
+import json
+import os
+import subprocess
+import sys
+import time
+
+DEFAULT_BUDGET_SECONDS = 10.0
+HEAVY_MODULES = ("torch", "clip", "gradio", "matplotlib", "google.generativeai")
+
+_CHILD = """
+import json, sys, time
+sys.path.insert(0, {repo_dir!r})
+start = time.perf_counter()
+from model_image_search import get_search_engine
+imported = time.perf_counter()
+heavy = [name for name in {heavy!r} if name in sys.modules]
+engine = get_search_engine({photo_ids_file!r}, {photo_features_file!r})
+loaded = time.perf_counter()
+engine.search({query!r}, 10)
+answered = time.perf_counter()
+print(json.dumps({{
+    "import_s": imported - start,
+    "heavy_modules_after_import": heavy,
+    "engine_load_s": loaded - imported,
+    "first_query_s": answered - loaded,
+}}))
+"""
+
+
+def measure_cold_start(photo_ids_file, photo_features_file, query="two birds flying above water", runs=3):
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for _ in range(runs):
+        code = _CHILD.format(repo_dir=repo_dir, heavy=HEAVY_MODULES, photo_ids_file=str(photo_ids_file),
+                             photo_features_file=str(photo_features_file), query=query)
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        total = time.perf_counter() - start
+        # The stage timings are the last line; anything before it is the engine's own output
+        stages = json.loads(output.stdout.strip().splitlines()[-1])
+        stages["total_s"] = total
+        results.append(stages)
+    totals = sorted(r["total_s"] for r in results)
+    return {"runs": results, "median_total_s": totals[len(totals) // 2]}
+
+
+if __name__ == "__main__":
+    photo_ids_file = sys.argv[1] if len(sys.argv) > 1 else "data/lite/features/photo_ids.csv"
+    photo_features_file = sys.argv[2] if len(sys.argv) > 2 else "data/lite/features/features.npy"
+    budget = float(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_BUDGET_SECONDS
+    report = measure_cold_start(photo_ids_file, photo_features_file)
+    report["budget_s"] = budget
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["median_total_s"] <= budget else 1)
@@ -3,10 +3,109 @@
 # Put the .TSV files in the folder data/full or data/lite or adjust the path in the cell below.
 from pathlib import Path
 import pandas as pd
-import urllib.request
-from multiprocessing.pool import ThreadPool
+import csv
+import http.client
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urljoin
 
-def download_data(version="lite", data_path="data",threads_count=8):
+# Status codes worth retrying: rate limiting and server-side errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class ConnectionPool:
+    """One persistent keep-alive connection per (thread, scheme, host), reused across photos"""
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def get(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault("connections", {})
+        key = (scheme, netloc)
+        if key not in connections:
+            connection_class = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            connections[key] = connection_class(netloc, timeout=self.timeout)
+        return connections[key]
+
+    def discard(self, scheme, netloc):
+        # Broken connections are closed and reopened on the next request
+        connection = self._local.__dict__.get("connections", {}).pop((scheme, netloc), None)
+        if connection is not None:
+            connection.close()
+
+
+class DownloadError(Exception):
+    def __init__(self, message, retryable=True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def fetch(pool, url, max_redirects=5):
+    """GET url over the pooled connection and return the body"""
+    for _ in range(max_redirects + 1):
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        connection = pool.get(parts.scheme, parts.netloc)
+        try:
+            connection.request("GET", path or "/", headers={"Connection": "keep-alive"})
+            response = connection.getresponse()
+            body = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            pool.discard(parts.scheme, parts.netloc)
+            raise DownloadError(f"{type(e).__name__}: {e}")
+        if response.will_close:
+            pool.discard(parts.scheme, parts.netloc)
+        if response.status in (301, 302, 303, 307, 308):
+            url = urljoin(url, response.getheader("Location"))
+            continue
+        if response.status != 200:
+            raise DownloadError(f"HTTP {response.status}", retryable=response.status in RETRY_STATUSES)
+        return body
+    raise DownloadError("Too many redirects", retryable=False)
+
+
+class DownloadManifest:
+    """Append-only record of completed and failed photo IDs, so reruns skip finished work"""
+
+    def __init__(self, manifest_file):
+        self.manifest_file = Path(manifest_file)
+        self.completed = set()
+        self.failed = {}
+        self._lock = threading.Lock()
+        if self.manifest_file.exists():
+            # Later lines win: a photo that failed once and then succeeded counts as completed
+            for row in pd.read_csv(self.manifest_file, dtype={"photo_id": str}, keep_default_na=False).itertuples():
+                if row.status == "completed":
+                    self.completed.add(row.photo_id)
+                    self.failed.pop(row.photo_id, None)
+                else:
+                    self.failed[row.photo_id] = row.error
+        is_new = not self.manifest_file.exists()
+        self._file = open(self.manifest_file, "a", newline="")
+        self._writer = csv.writer(self._file)
+        if is_new:
+            self._writer.writerow(["photo_id", "status", "attempts", "error"])
+
+    def record(self, photo_id, status, attempts, error=""):
+        with self._lock:
+            if status == "completed":
+                self.completed.add(photo_id)
+                self.failed.pop(photo_id, None)
+            else:
+                self.failed[photo_id] = error
+            self._writer.writerow([photo_id, status, attempts, error])
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def download_data(version="lite", data_path="data",threads_count=8, retries=4, backoff=0.5, timeout=30,
+                  retry_failed=True, on_photo=None):
     dataset_version = version # either "lite" or "full"
     unsplash_dataset_path = Path(data_path) / dataset_version
 
@@ -15,8 +114,8 @@ def download_data(version="lite", data_path="data",threads_count=8):
 # Read the photos table
     photos = pd.read_csv(unsplash_dataset_path / "photos.tsv000", sep='\t', header=0)
 
-    # Extract the IDs and the URLs of the photos
-    # photo_metadata = photos[['photo_id', 'photo_description']]
+    # Extract the IDs, descriptions and the URLs of the photos
+    photo_metadata = photos[['photo_id', 'photo_description']]
 
     photo_urls = photos[['photo_id', 'photo_image_url']].values.tolist()
 
@@ -29,36 +128,85 @@ def download_data(version="lite", data_path="data",threads_count=8):
         print("📁 Folder created:", photos_donwload_path)
     else:
         print("✅ Folder already exists:", photos_donwload_path)
+
+    # The manifest lets a rerun skip completed photos without stat-ing every path
+    manifest = DownloadManifest(unsplash_dataset_path / "download_manifest.csv")
+    todo = [photo for photo in photo_urls
+            if photo[0] not in manifest.completed and (retry_failed or photo[0] not in manifest.failed)]
+    print(f'Photos already downloaded: {len(manifest.completed)}, failed before: {len(manifest.failed)}, '
+          f'to download: {len(todo)}')
+
+    pool = ConnectionPool(timeout)
+    stats = {"photos": 0, "bytes": 0, "failed": 0}
+    stats_lock = threading.Lock()
+    start_time = time.perf_counter()
+
     # Function that downloads a single photo
     def download_photo(photo):
         # Get the ID of the photo
         photo_id = photo[0]
+        attempt = 0
+        error = ""
+        try:
+            # Get the URL of the photo (setting the width to 640 pixels)
+            photo_url = photo[1] + "?w=640"
 
-        # Get the URL of the photo (setting the width to 640 pixels)
-        photo_url = photo[1] + "?w=640"
+            # Path where the photo will be stored
+            photo_path = photos_donwload_path / (photo_id + ".jpg")
 
-        # Path where the photo will be stored
-        photo_path = photos_donwload_path / (photo_id + ".jpg")
+            # Photos from before the manifest existed are recorded without downloading them again
+            if photo_path.exists():
+                manifest.record(photo_id, "completed", 0)
+                return
 
-        # Only download a photo if it doesn't exist
-        if not photo_path.exists():
-            try:
-                urllib.request.urlretrieve(photo_url, photo_path)
-            except:
-                # Catch the exception if the download fails for some reason
-                print(f"Cannot download {photo_url}")
-                # photo_metadata =  photo_metadata[photo_metadata['photo_id'] != photo_id]
+            for attempt in range(1, retries + 1):
+                try:
+                    data = fetch(pool, photo_url)
+                except DownloadError as e:
+                    error = str(e)
+                    if not e.retryable or attempt == retries:
+                        break
+                    # Exponential backoff with full jitter, so threads don't retry in lockstep
+                    time.sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
+                    continue
+                # Write to a partial file and rename, so a crash never leaves a truncated .jpg behind
+                part_path = photo_path.with_name(photo_path.name + ".part")
+                with open(part_path, "wb") as f:
+                    f.write(data)
+                os.replace(part_path, photo_path)
+                manifest.record(photo_id, "completed", attempt)
+                # Lets a consumer (e.g. the pipelined ingest) start on the photo right away
+                if on_photo is not None:
+                    on_photo(photo_id, photo_path)
+                with stats_lock:
+                    stats["photos"] += 1
+                    stats["bytes"] += len(data)
+                    if stats["photos"] % 1000 == 0:
+                        elapsed = time.perf_counter() - start_time
+                        print(f'Downloaded {stats["photos"]}/{len(todo)} photos ({stats["photos"] / elapsed:.1f} photos/sec)')
+                return
+        except Exception as e:
+            # Anything else (a full disk, a missing URL, a failing on_photo) only fails this photo
+            error = f"{type(e).__name__}: {e}"
 
-                pass
+        # Catch the exception if the download fails for some reason
+        print(f"Cannot download {photo_id}: {error}")
+        manifest.record(photo_id, "failed", attempt, error)
+        with stats_lock:
+            stats["failed"] += 1
 
 # Now the actual download! The download can be parallelized very well, so we will use a thread pool. You may need to tune the threads_count parameter to achieve the optimzal performance based on your Internet connection. For me even 128 worked quite well.
-# Create the thread pool
-    threads_count = threads_count
-    pool = ThreadPool(threads_count)
-    # Start the download
-    pool.map(download_photo, photo_urls)
+# Each thread keeps its own keep-alive connection, so the pool size bounds the open connections
+    try:
+        with ThreadPoolExecutor(max_workers=threads_count) as executor:
+            # Start the download
+            list(executor.map(download_photo, todo))
+    finally:
+        manifest.close()
 
     # Display some statistics
-    print(f'Photos downloaded: {len(photos)} to {unsplash_dataset_path}')
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    print(f'Photos downloaded: {stats["photos"]}, failed: {stats["failed"]}, to {unsplash_dataset_path} '
+          f'in {elapsed:.1f}s ({stats["photos"] / elapsed:.1f} photos/sec, {stats["bytes"] / elapsed / 1e6:.2f} MB/s)')
 
-    # return photo_metadata
\ No newline at end of file
+    return photo_metadata
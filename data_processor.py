@@ -1,18 +1,169 @@
 # process_Unsplash_dataset
+import os
 from pathlib import Path
-import clip
-import torch
-from PIL import Image
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import time
+import threading
 import numpy as np
 import pandas as pd
 import math
 
-# Load the open CLIP model
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
+from ann_index import build_index, index_path
+from dedup import duplicates_path, find_duplicates
+from feature_store import STORE_DTYPE, convert_to_float16
+from index_manifest import IndexManifest
+from lexical_index import build_lexical_index, lexical_index_path
+from metadata_store import build_metadata, metadata_path
+from neighbor_graph import build_knn_graph, graph_paths
+from quantization import build_codes, codes_path
+from thumbnails import generate_thumbnails, DEFAULT_SIZES, DEFAULT_QUALITY
+
+# Size of the ViT-B/32 image embeddings, used for an empty index when no file tells the size
+EMBEDDING_DIM = 512
+
+# The open CLIP model, loaded on first use so importing this module stays cheap
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """(model, preprocess, device) of the CLIP image encoder, loaded once"""
+    global _model
+    with _model_lock:
+        if _model is None:
+            import clip
+            import torch
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            model, preprocess = clip.load("ViT-B/32", device=device)
+            _model = (model, preprocess, device)
+        return _model
+
+
+def set_model(model, preprocess, device="cpu"):
+    """Use an already loaded (or stub) image encoder instead of loading CLIP"""
+    global _model
+    with _model_lock:
+        _model = (model, preprocess, device)
+
+
+def load_photo(photo_file):
+    # Decode and preprocess one photo; runs on the worker threads
+    from PIL import Image
+    _, preprocess, _ = get_model()
+    with Image.open(photo_file) as photo:
+        return preprocess(photo)
+
+
+def prefetch_batches(batches, workers=4, queue_depth=4):
+    """Yield (i, batch_files, futures) in order while the next queue_depth batches decode in the background.
+
+    batches is an iterable of (i, batch_files); futures holds one preprocessed tensor per photo.
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess") as pool:
+        batches = iter(batches)
+        pending = deque()
+
+        def submit_next():
+            for i, batch_files in batches:
+                pending.append((i, batch_files, [pool.submit(load_photo, f) for f in batch_files]))
+                return
+
+        for _ in range(queue_depth):
+            submit_next()
+        while pending:
+            batch = pending.popleft()
+            # Keep the queue full while the caller encodes this batch
+            submit_next()
+            yield batch
+
+
+def encode_photos(photos_preprocessed):
+    import torch
+    model, _, device = get_model()
+    with torch.no_grad():
+        # Encode the photos batch to compute the feature vectors and normalize them
+        photos_features = model.encode_image(photos_preprocessed.to(device))
+        photos_features /= photos_features.norm(dim=-1, keepdim=True)
+
+    # Transfer the feature vectors back to the CPU and convert to numpy
+    return photos_features.cpu().numpy()
+
+def write_shard(manifest, shard, batch_files, photo_futures, descriptions):
+    """Encode one batch of preprocessed photos, save it as a shard and record it in the manifest"""
+    loaded = []
+    for photo_file, future in zip(batch_files, photo_futures):
+        try:
+            loaded.append((photo_file, future.result()))
+        except Exception as e:
+            # An unreadable photo is skipped, the rest of its batch is still indexed
+            print(f"Skipping {photo_file.name}: {e}")
+    if not loaded:
+        return 0
+    batch_files = [photo_file for photo_file, _ in loaded]
+    batch_features_path, batch_ids_path = manifest.shard_files(shard)
+    batch_ids = [photo_file.stem for photo_file in batch_files]
+
+    import torch
+    # Compute the features and save to a numpy file
+    batch_features = encode_photos(torch.stack([photo for _, photo in loaded]))
+    np.save(batch_features_path, batch_features)
+
+    # Save the photo IDs and description to a CSV file
+    photo_ids_data = pd.DataFrame({
+        'photo_id': batch_ids,
+        'description': [descriptions.get(photo_id, "") for photo_id in batch_ids],
+    })
+    photo_ids_data.to_csv(batch_ids_path, index=False)
+
+    # Recorded last, so a crash never leaves the manifest pointing at a partial shard
+    manifest.add_shard(shard, batch_ids, [photo_file.stat().st_mtime_ns for photo_file in batch_files])
+    return len(batch_files)
+
+
+def merge_shards(manifest, features_file, photo_ids_file, progress_every=100, dim=EMBEDDING_DIM):
+    """Stream the live rows of every shard into features.npy and photo_ids.csv.
+
+    Only one shard is in memory at a time: features go into a preallocated memory-mapped float16
+    file and ids are appended to the CSV as they are read. Both are written to temporary files and
+    renamed into place at the end, so readers of the old files are never disturbed.
+    The width of the features is read from the shards, or from the previous features.npy when every
+    photo was removed; dim is only used for an index that has never had any photo.
+    """
+    active = manifest.active()
+    shards = [(shard, rows["row"].to_numpy()) for shard, rows in active.groupby("shard", sort=True)]
+    if shards:
+        dim = np.load(manifest.shard_files(shards[0][0])[0], mmap_mode="r").shape[1]
+    elif features_file.exists():
+        dim = np.load(features_file, mmap_mode="r").shape[1]
+
+    tmp_features_file = features_file.with_name("features.tmp.npy")
+    tmp_photo_ids_file = photo_ids_file.with_name("photo_ids.tmp.csv")
+    features = np.lib.format.open_memmap(tmp_features_file, mode="w+", dtype=STORE_DTYPE, shape=(len(active), dim))
+    start_time = time.perf_counter()
+    offset = 0
+    with open(tmp_photo_ids_file, "w", newline="") as ids_output:
+        ids_output.write("photo_id,description\n")
+        for n, (shard, rows) in enumerate(shards):
+            shard_features_path, shard_ids_path = manifest.shard_files(shard)
+            features[offset:offset + len(rows)] = np.load(shard_features_path)[rows]
+            pd.read_csv(shard_ids_path, dtype={'photo_id': str}).iloc[rows].to_csv(ids_output, header=False, index=False)
+            offset += len(rows)
+            if (n + 1) % progress_every == 0 or n + 1 == len(shards):
+                print(f"Merged {n + 1}/{len(shards)} shards, {offset}/{len(active)} photos "
+                      f"({time.perf_counter() - start_time:.1f}s)")
+    features.flush()
+    del features
+
+    # Atomic swap of the merged files
+    os.replace(tmp_features_file, features_file)
+    os.replace(tmp_photo_ids_file, photo_ids_file)
+
 
 # Set the path to the photos
-def process_data(photo_metadata, file_path, version="lite",batch_size=16):
+def process_data(photo_metadata, file_path, version="lite",batch_size=16, build_ann_index=False, quantize=None,
+                 thumbnail_sizes=DEFAULT_SIZES, thumbnail_quality=DEFAULT_QUALITY, workers=4, queue_depth=4,
+                 build_neighbor_graph=False, dedup_threshold=None):
     # version="lite"
     # batch_size=16
     dataset_version = version  # Use "lite" or "full"
@@ -20,70 +171,107 @@ def process_data(photo_metadata, file_path, version="lite",batch_size=16):
     # Path where the feature vectors will be stored
     features_path = Path(file_path) / dataset_version / "features"
 
-    # List all JPGs in the folder
-    photos_files = list(photos_path.glob("*.jpg"))
-    # photos_files = photo_metadata['photo_id']
-    total_photos_files_num = len(photos_files)
-
-    # Function that computes the feature vectors for a batch of images
-    def compute_clip_features(photos_batch):
-        # Load all the photos from the files
-        photos = [Image.open(photo_file) for photo_file in photos_batch]
-
-        # Preprocess all photos
-        photos_preprocessed = torch.stack([preprocess(photo) for photo in photos]).to(device)
-
-        with torch.no_grad():
-            # Encode the photos batch to compute the feature vectors and normalize them
-            photos_features = model.encode_image(photos_preprocessed)
-            photos_features /= photos_features.norm(dim=-1, keepdim=True)
-
-        # Transfer the feature vectors back to the CPU and convert to numpy
-        return photos_features.cpu().numpy()
-
-    #Process all photos
-    # Compute how many batches are needed
-    batches_num = math.ceil(total_photos_files_num / batch_size)
-
-    # Process each batch
-    for i in range(batches_num):
-        print(f"Processing batch {i + 1}/{batches_num}")
-
-        batch_ids_path = features_path / f"{i:010d}.csv"
-        batch_features_path = features_path / f"{i:010d}.npy"
-
-        # Only do the processing if the batch wasn't processed yet
-        if not batch_features_path.exists():
-            try:
-                # Select the photos for the current batch
-                batch_files = photos_files[i * batch_size: (i + 1) * batch_size]
-
-                # Compute the features and save to a numpy file
-                batch_features = compute_clip_features(batch_files)
-                np.save(batch_features_path, batch_features)
-
-                # Save the photo IDs and description to a CSV file
-                # photo_ids = [photo_file.name.split(".")[0] for photo_file in batch_files]
-                photo_ids_data = pd.DataFrame(photo_ids_metadata, columns=['photo_id','description'])
-                photo_ids_data.to_csv(batch_ids_path, index=False)
-            except:
-                # Catch problems with the processing to make the process more robust
-                print(f'Problem with batch {i}')
-    # Merge the features and the photo IDs. The resulting files are features.npy and photo_ids.csv
-
-
-    # Load all numpy files
-    features_list = [np.load(features_file) for features_file in sorted(features_path.glob("*.npy"))]
-
-    # Concatenate the features and store in a merged file
-    features = np.concatenate(features_list)
-    features_file = features_path / "features.npy"
-    np.save(features_file, features)
-
-    # Load all the photo IDs
-    photo_ids = pd.concat([pd.read_csv(ids_file) for ids_file in sorted(features_path.glob("*.csv"))])
-    photo_ids_file = features_path / "photo_ids.csv"
-    photo_ids.to_csv(photo_ids_file, index=False)
+    # List all JPGs in the folder, keyed by photo ID
+    photos = {photo_file.stem: photo_file.stat().st_mtime_ns for photo_file in photos_path.glob("*.jpg")}
+    # Descriptions from the dataset metadata, when download_data provided it
+    descriptions = {}
+    if photo_metadata is not None:
+        descriptions = dict(zip(photo_metadata['photo_id'], photo_metadata['photo_description'].fillna("")))
+
+    # The manifest records which photos are already embedded, so only new or changed photos are encoded
+    manifest = IndexManifest(features_path)
+    manifest.remove_orphan_shards()
+    new_ids, removed_ids = manifest.plan(photos)
+    if removed_ids:
+        print(f"Tombstoning {len(removed_ids)} removed or changed photos")
+        manifest.tombstone(removed_ids)
+
+    #Process all new photos
+    # Compute how many batches are needed; every batch becomes a new shard
+    batches_num = math.ceil(len(new_ids) / batch_size)
+    first_shard = manifest.next_shard()
+    new_batches = [
+        (first_shard + i, [photos_path / f"{photo_id}.jpg" for photo_id in new_ids[i * batch_size: (i + 1) * batch_size]])
+        for i in range(batches_num)
+    ]
+
+    # Worker threads decode and preprocess the next batches while the model encodes the current one
+    encoded_count = 0
+    start_time = time.perf_counter()
+    for shard, batch_files, photo_futures in prefetch_batches(new_batches, workers, queue_depth):
+        print(f"Processing batch {shard - first_shard + 1}/{batches_num}")
+
+        try:
+            encoded_count += write_shard(manifest, shard, batch_files, photo_futures, descriptions)
+        except Exception as e:
+            # Catch problems with the processing to make the process more robust
+            print(f'Problem with batch {shard - first_shard}: {e}')
+    elapsed = time.perf_counter() - start_time
+    if encoded_count:
+        print(f"Encoded {encoded_count} photos in {elapsed:.1f}s ({encoded_count / elapsed:.1f} images/sec)")
+
+    return finish_index(manifest, file_path, dataset_version, bool(encoded_count or removed_ids),
+                        build_ann_index, quantize, thumbnail_sizes, thumbnail_quality, build_neighbor_graph,
+                        dedup_threshold)
+
+
+def remove_derived_files(features_file):
+    """Delete the files computed from the rows of features_file, which a merge invalidates.
+
+    The ones that are asked for are built again by finish_index; the others would otherwise be
+    loaded by SearchEngine with rows that no longer match photo_ids.csv.
+    """
+    derived_files = [index_path(features_file), codes_path(features_file, "int8"), codes_path(features_file, "binary"),
+                     *graph_paths(features_file), duplicates_path(features_file),
+                     duplicates_path(features_file).with_name("duplicate_clusters.csv"), metadata_path(features_file),
+                     lexical_index_path(features_file)]
+    removed = [path.name for path in derived_files if path.exists()]
+    for path in derived_files:
+        path.unlink(missing_ok=True)
+    if removed:
+        print(f"Removed {', '.join(removed)}, built from the previous features")
+
+
+def finish_index(manifest, file_path, version, changed, build_ann_index=False, quantize=None,
+                 thumbnail_sizes=DEFAULT_SIZES, thumbnail_quality=DEFAULT_QUALITY, build_neighbor_graph=False,
+                 dedup_threshold=None):
+    """Merge the shards if anything changed, then build the optional derived files"""
+    features_file = manifest.features_path / "features.npy"
+    photo_ids_file = manifest.features_path / "photo_ids.csv"
+    # Merge the live entries of every shard. The resulting files are features.npy and photo_ids.csv
+    if changed or not features_file.exists() or not photo_ids_file.exists():
+        merge_shards(manifest, features_file, photo_ids_file)
+        remove_derived_files(features_file)
+    else:
+        print("Index is up to date")
+        # A features.npy from before the float16 store is converted here, searchers never write it
+        convert_to_float16(features_file)
+
+    # Columnar photo metadata aligned with the merged rows, used by filtered searches
+    photos_file = Path(file_path) / version / "photos.tsv000"
+    if photos_file.exists() and (changed or not metadata_path(features_file).exists()):
+        build_metadata(photos_file, photo_ids_file, features_file)
+    # BM25 index of the descriptions for lexical and hybrid search
+    if changed or not lexical_index_path(features_file).exists():
+        build_lexical_index(photo_ids_file, features_file, photos_file)
+
+    # Downscaled copies used for display and reranking, thumbnail_sizes is (display size, rerank size);
+    # they are recorded with the quality so the UIs and the reranker use these files. None skips it
+    if thumbnail_sizes:
+        generate_thumbnails(file_path, version, sizes=thumbnail_sizes, quality=thumbnail_quality)
+
+    # Optionally build the IVF index used by SearchEngine(use_index=True)
+    if build_ann_index:
+        build_index(features_file)
+    # Optionally write "int8" or "binary" codes used by SearchEngine(quantization=...)
+    if quantize is not None:
+        build_codes(features_file, quantize)
+    # Optionally precompute the k-NN graph used by SearchEngine.more_like_this()
+    if build_neighbor_graph:
+        build_knn_graph(features_file)
+    # Optionally cluster the near-duplicates, used by SearchEngine(collapse_duplicates=True)
+    if dedup_threshold is not None:
+        find_duplicates(features_file, photo_ids_file, dedup_threshold)
 
     return photo_ids_file,features_file
 # generate the files
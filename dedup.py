@@ -0,0 +1,114 @@
+# Offline near-duplicate detection over the CLIP photo features.
+# All pairs of photos with cosine similarity >= threshold are found with tiled matrix products:
+# the upper triangle of the (N x N) similarity matrix is split into (block x block) tiles that are
+# scored independently in a thread pool (numpy releases the GIL), so memory stays at one tile per
+# worker whatever N is. The pairs are grouped into clusters with union-find; every cluster is
+# represented by its lowest row, and SearchEngine(collapse_duplicates=True) shows one photo per cluster.
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_THRESHOLD = 0.95
+# 4096 x 4096 float32 scores are a 64MB tile
+DEFAULT_TILE_SIZE = 4096
+
+
+def duplicates_path(features_file):
+    """The clusters are saved next to the features they were computed from"""
+    return Path(features_file).with_name("duplicates.npz")
+
+
+def _tile_pairs(features, row_start, column_start, tile_size, threshold):
+    # (rows, columns, scores) of the pairs above threshold in one tile, each pair once (row < column)
+    rows_block = np.asarray(features[row_start:row_start + tile_size], dtype=np.float32)
+    columns_block = np.asarray(features[column_start:column_start + tile_size], dtype=np.float32)
+    scores = rows_block @ columns_block.T
+    rows, columns = np.nonzero(scores >= threshold)
+    rows = rows + row_start
+    columns = columns + column_start
+    # Diagonal tiles hold every pair twice and each photo with itself
+    keep = rows < columns
+    return rows[keep], columns[keep], scores[rows[keep] - row_start, columns[keep] - column_start]
+
+
+def find_duplicate_pairs(features, threshold=DEFAULT_THRESHOLD, tile_size=DEFAULT_TILE_SIZE, threads_count=None):
+    """(rows, columns, scores) of every pair of rows with a similarity >= threshold"""
+    total = features.shape[0]
+    tiles = [(row_start, column_start)
+             for row_start in range(0, total, tile_size)
+             for column_start in range(row_start, total, tile_size)]
+    with ThreadPoolExecutor(max_workers=threads_count or os.cpu_count()) as executor:
+        results = list(executor.map(lambda tile: _tile_pairs(features, *tile, tile_size, threshold), tiles))
+    rows = np.concatenate([r[0] for r in results]).astype(np.int64)
+    columns = np.concatenate([r[1] for r in results]).astype(np.int64)
+    scores = np.concatenate([r[2] for r in results]).astype(np.float32)
+    return rows, columns, scores
+
+
+def cluster_pairs(total, rows, columns):
+    """Representative (lowest row of its cluster) of every row, from the duplicate pairs"""
+    parent = {}
+
+    def find(i):
+        root = i
+        while parent.get(root, root) != root:
+            root = parent[root]
+        # Path compression
+        while parent.get(i, i) != root:
+            parent[i], i = root, parent[i]
+        return root
+
+    for i, j in zip(rows.tolist(), columns.tolist()):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            # The lower row becomes the root, so every root is the lowest row of its cluster
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    # Only rows that appear in a pair can have another representative than themselves
+    representatives = np.arange(total, dtype=np.int64)
+    for i in list(parent):
+        representatives[i] = find(i)
+    return representatives
+
+
+def find_duplicates(features_file, photo_ids_file=None, threshold=DEFAULT_THRESHOLD, tile_size=DEFAULT_TILE_SIZE,
+                    threads_count=None):
+    """Find the duplicate clusters of a features.npy and save them next to it"""
+    features = np.load(features_file, mmap_mode="r")
+    start_time = time.perf_counter()
+    rows, columns, scores = find_duplicate_pairs(features, threshold, tile_size, threads_count)
+    representatives = cluster_pairs(features.shape[0], rows, columns)
+    output_file = duplicates_path(features_file)
+    tmp_file = output_file.with_name("duplicates.tmp.npz")
+    np.savez(tmp_file, representatives=representatives, rows=rows, columns=columns, scores=scores,
+             threshold=threshold)
+    os.replace(tmp_file, output_file)
+
+    duplicated = representatives != np.arange(len(representatives))
+    clusters_count = len(np.unique(representatives[duplicated]))
+    print(f"{len(rows)} duplicate pairs (cosine >= {threshold}) in {clusters_count} clusters, "
+          f"{duplicated.sum()} redundant photos of {len(representatives)}, "
+          f"found in {time.perf_counter() - start_time:.1f}s and saved to {output_file}")
+    if photo_ids_file is not None:
+        # Human-readable list of the clustered photos
+        photo_ids = pd.read_csv(photo_ids_file)["photo_id"].to_numpy()
+        clustered = np.flatnonzero(np.isin(representatives, representatives[duplicated]))
+        pd.DataFrame({"photo_id": photo_ids[clustered], "representative_id": photo_ids[representatives[clustered]]}) \
+            .to_csv(output_file.with_name("duplicate_clusters.csv"), index=False)
+    return output_file
+
+
+def load_representatives(features_file):
+    return np.load(duplicates_path(features_file))["representatives"]
+
+
+if __name__ == "__main__":
+    # python dedup.py data/lite/features/features.npy [threshold]
+    import sys
+
+    features_file = sys.argv[1] if len(sys.argv) > 1 else "data/lite/features/features.npy"
+    threshold = float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_THRESHOLD
+    find_duplicates(features_file, Path(features_file).with_name("photo_ids.csv"), threshold)
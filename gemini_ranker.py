@@ -1,40 +1,175 @@
-import google.generativeai as genai
+import os
 import re
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import lru_cache
 
+from metrics import count, span
+from thumbnails import get_thumbnail, thumbnail_settings
 
-def gemini_rank(best_photo_ids_raw,file_path,version,search_query,results_count_final):
-    # Your Gemini API key
-    genai.configure(api_key="your-key")
-    model = genai.GenerativeModel("gemini-1.5-flash")
-    images = []
-    for i, photo_id in enumerate(best_photo_ids_raw):
-        photo_image_path = f"{file_path}/{version}/photos/{photo_id}.jpg"
-        with open(photo_image_path, "rb") as f:
-            img_data = f.read()
-        images.append({
-            "mime_type": "image/jpeg",
-            "data": img_data
-        })
-
-    #     img_data = Image.open(photo_image_path)
-    #     images.append({
-    #     "name": photo_id,
-    #     "data": img_data
-    # })
-
-    query = f"Select the {results_count_final} most relevant images that look like {search_query}.Return only the image id of the selected images. "
-    #     query = [{"role": "user", "parts": [
-    #     f"Here are {results_count} images. Please select {results_count_final} images that best match the prompt {search_query}. Return only the image names of the selected images."
-    # ]}]
-    # 📤 Send to Gemini
-    response = model.generate_content(
-        [query] + images
-    )
-    if response.candidates is None:
-        print("Can't find images aligned with search query. Try again")
-        image_ids = []
-    else:
+# Seconds a rerank may take before the CLIP ordering is returned instead
+DEFAULT_LATENCY_BUDGET = 10.0
+DEFAULT_GEMINI_MODEL = "gemini-1.5-flash"
+
+
+class RerankBackend(ABC):
+    """Selects the results_count_final best images; returns their 1-based positions in images"""
+
+    @abstractmethod
+    def rank(self, search_query, images, results_count_final):
+        pass
+
+    @property
+    def cache_name(self):
+        # Part of the rerank cache key, so two backends never share cached rankings
+        return type(self).__name__
+
+
+class GeminiBackend(RerankBackend):
+    def __init__(self, api_key=None, model_name=DEFAULT_GEMINI_MODEL, timeout=DEFAULT_LATENCY_BUDGET):
+        # Imported here, the SDK is slow to import and only needed when Gemini is used
+        import google.generativeai as genai
+        # Your Gemini API key
+        genai.configure(api_key=api_key or os.environ.get("GEMINI_API_KEY", "your-key"))
+        # Built once and reused by every call
+        self.model = genai.GenerativeModel(model_name)
+        self.model_name = model_name
+        self.timeout = timeout
+
+    @property
+    def cache_name(self):
+        return f"GeminiBackend:{self.model_name}"
+
+    def rank(self, search_query, images, results_count_final):
+        query = f"Select the {results_count_final} most relevant images that look like {search_query}.Return only the image id of the selected images. "
+        # 📤 Send to Gemini
+        response = self.model.generate_content(
+            [query] + images,
+            request_options={"timeout": self.timeout}
+        )
+        if response.candidates is None:
+            print("Can't find images aligned with search query. Try again")
+            return []
         print(response.text)
-        image_ids = list(map(int, re.findall(r'\d+', response.text)))
+        return list(map(int, re.findall(r'\d+', response.text)))
+
+
+class StubBackend(RerankBackend):
+    """Local stand-in for Gemini in tests and benchmarks: keeps the CLIP order after an optional delay"""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+
+    def rank(self, search_query, images, results_count_final):
+        self.calls += 1
+        if self.delay:
+            threading.Event().wait(self.delay)
+        return list(range(1, min(results_count_final, len(images)) + 1))
+
+
+@lru_cache(maxsize=256)
+def _read_bytes(photo_image_path, mtime):
+    with open(photo_image_path, "rb") as f:
+        return f.read()
+
+
+def read_photo(photo_image_path):
+    # Keyed on the modification time too, so a regenerated thumbnail is read again
+    return _read_bytes(photo_image_path, os.stat(photo_image_path).st_mtime)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+# Rerank results keyed on (backend, query, ordered candidate ids, results_count_final)
+_rerank_cache = OrderedDict()
+_rerank_cache_size = 1024
+_rerank_cache_lock = threading.Lock()
+# Backend calls run here so a slow request can be abandoned when the budget runs out
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="rerank")
+
+
+def set_backend(backend):
+    global _backend
+    with _backend_lock:
+        _backend = backend
+
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = GeminiBackend()
+        return _backend
+
+
+def _backend_name(backend):
+    # Cache name of the backend a call will use, without building the default Gemini client
+    if backend is None:
+        with _backend_lock:
+            backend = _backend
+        if backend is None:
+            return f"GeminiBackend:{DEFAULT_GEMINI_MODEL}"
+    return backend.cache_name
+
+
+def clear_rerank_cache():
+    with _rerank_cache_lock:
+        _rerank_cache.clear()
+
+
+def gemini_rank(best_photo_ids_raw, file_path, version, search_query, results_count_final,
+                backend=None, latency_budget=DEFAULT_LATENCY_BUDGET):
+    key = (_backend_name(backend), search_query, tuple(best_photo_ids_raw), results_count_final)
+    with _rerank_cache_lock:
+        if key in _rerank_cache:
+            _rerank_cache.move_to_end(key)
+            count("rerank_cache_lookups", result="hit")
+            return list(_rerank_cache[key])
+    count("rerank_cache_lookups", result="miss")
+    # Resolved on a miss only, so a cache hit never builds the Gemini client
+    backend = backend or get_backend()
+    # The budget covers preparing the images as well as the backend call
+    deadline = time.perf_counter() + latency_budget
+
+    images = []
+    rerank_size = thumbnail_settings(file_path, version)["rerank_size"]
+    with span("rerank_images"):
+        for i, photo_id in enumerate(best_photo_ids_raw):
+            # Send the small derivative instead of the 640px original
+            photo_image_path = get_thumbnail(file_path, version, photo_id, rerank_size)
+            images.append({
+                "mime_type": "image/jpeg",
+                "data": read_photo(photo_image_path)
+            })
+
+    # CLIP ordering, used when the backend is too slow or fails
+    fallback = list(range(1, min(results_count_final, len(best_photo_ids_raw)) + 1))
+    remaining = deadline - time.perf_counter()
+    if remaining <= 0:
+        print(f"Preparing the images exceeded {latency_budget}s, keeping the CLIP ordering")
+        count("rerank_fallbacks", reason="timeout")
+        return fallback
+    future = _executor.submit(backend.rank, search_query, images, results_count_final)
+    try:
+        with span("rerank"):
+            image_ids = future.result(timeout=remaining)
+    except TimeoutError:
+        print(f"Reranking exceeded {latency_budget}s, keeping the CLIP ordering")
+        count("rerank_fallbacks", reason="timeout")
+        return fallback
+    except Exception as e:
+        print(f"Reranking failed ({e}), keeping the CLIP ordering")
+        count("rerank_fallbacks", reason="error")
+        return fallback
 
+    # Drop anything that is not a valid 1-based position in the candidates
+    image_ids = [i for i in image_ids if 1 <= i <= len(best_photo_ids_raw)]
+    with _rerank_cache_lock:
+        _rerank_cache[key] = image_ids
+        while len(_rerank_cache) > _rerank_cache_size:
+            _rerank_cache.popitem(last=False)
     return image_ids
@@ -0,0 +1,102 @@
+# Manifest of the photos that have been embedded, keyed by photo_id.
+# Every encoded batch is written as a new, immutable shard (shards/<n>.npy + shards/<n>.csv) and its
+# photos are appended to manifest.csv with their shard and row. Deleted or changed photos are
+# tombstoned instead of rewriting shards, so an update only encodes the photos that are new.
+# File modification times are recorded as integer nanoseconds (st_mtime_ns): a float st_mtime
+# does not survive the CSV round trip exactly, which made unchanged photos look modified.
+import os
+from pathlib import Path
+
+import pandas as pd
+
+MANIFEST_COLUMNS = ["photo_id", "shard", "row", "mtime_ns", "deleted"]
+# Float mtimes of older manifests are trusted within this many nanoseconds of the file's
+LEGACY_MTIME_TOLERANCE_NS = 1_000_000
+
+
+class IndexManifest:
+    def __init__(self, features_path):
+        self.features_path = Path(features_path)
+        self.shards_path = self.features_path / "shards"
+        self.manifest_file = self.features_path / "manifest.csv"
+        self.shards_path.mkdir(parents=True, exist_ok=True)
+        # Set when the manifest was written with float mtimes, which plan() converts once
+        self.legacy_mtimes = False
+        if self.manifest_file.exists():
+            self.entries = pd.read_csv(self.manifest_file, dtype={"photo_id": str})
+            if "mtime_ns" not in self.entries:
+                self.legacy_mtimes = True
+                self.entries["mtime_ns"] = (self.entries.pop("mtime") * 1e9).round().astype("int64")
+                self.entries = self.entries[MANIFEST_COLUMNS]
+            self.entries["mtime_ns"] = self.entries["mtime_ns"].astype("int64")
+        else:
+            self.entries = pd.DataFrame({
+                "photo_id": pd.Series(dtype=str),
+                "shard": pd.Series(dtype="int64"),
+                "row": pd.Series(dtype="int64"),
+                "mtime_ns": pd.Series(dtype="int64"),
+                "deleted": pd.Series(dtype=bool),
+            })
+
+    def shard_files(self, shard):
+        return self.shards_path / f"{shard:010d}.npy", self.shards_path / f"{shard:010d}.csv"
+
+    def active(self):
+        """Live entries in index order: by shard, then by row inside the shard"""
+        active = self.entries[~self.entries["deleted"].astype(bool)]
+        return active.sort_values(["shard", "row"], kind="stable")
+
+    def next_shard(self):
+        return int(self.entries["shard"].max()) + 1 if len(self.entries) else 0
+
+    def plan(self, photos):
+        """(new photo_ids to encode, photo_ids to tombstone) for photos = {photo_id: st_mtime_ns} on disk"""
+        if self.legacy_mtimes:
+            self._upgrade_mtimes(photos)
+        active = self.active().set_index("photo_id")["mtime_ns"]
+        # A photo whose file changed since it was embedded is tombstoned and encoded again
+        changed = [photo_id for photo_id, mtime_ns in photos.items()
+                   if photo_id in active.index and mtime_ns != active[photo_id]]
+        removed = [photo_id for photo_id in active.index if photo_id not in photos]
+        new = [photo_id for photo_id in photos if photo_id not in active.index] + changed
+        return new, removed + changed
+
+    def _upgrade_mtimes(self, photos):
+        # The float mtimes lost precision in the CSV: the ones within the tolerance of the file's
+        # are taken as unchanged and replaced by its exact st_mtime_ns
+        on_disk = self.entries["photo_id"].map(photos)
+        same = on_disk.notna() & ((on_disk - self.entries["mtime_ns"]).abs() <= LEGACY_MTIME_TOLERANCE_NS)
+        self.entries.loc[same, "mtime_ns"] = on_disk[same].astype("int64")
+        self.legacy_mtimes = False
+        self.save()
+
+    def add_shard(self, shard, photo_ids, mtimes_ns):
+        rows = pd.DataFrame({
+            "photo_id": photo_ids,
+            "shard": shard,
+            "row": range(len(photo_ids)),
+            "mtime_ns": pd.Series(mtimes_ns, dtype="int64"),
+            "deleted": False,
+        }, columns=MANIFEST_COLUMNS)
+        # Appending is cheap and the shard files are already complete when their rows appear here
+        rows.to_csv(self.manifest_file, mode="a", header=not self.manifest_file.exists(), index=False)
+        self.entries = pd.concat([self.entries, rows], ignore_index=True)
+
+    def tombstone(self, photo_ids):
+        photo_ids = set(photo_ids)
+        self.entries.loc[self.entries["photo_id"].isin(photo_ids), "deleted"] = True
+        self.save()
+
+    def save(self):
+        tmp_file = self.manifest_file.with_name("manifest.tmp.csv")
+        self.entries.to_csv(tmp_file, index=False)
+        os.replace(tmp_file, self.manifest_file)
+
+    def remove_orphan_shards(self):
+        # Shards written by a run that stopped before recording them in the manifest
+        known = set(self.entries["shard"].astype(int))
+        for shard_file in self.shards_path.glob("*.npy"):
+            if int(shard_file.stem) not in known:
+                print(f"Removing unrecorded shard {shard_file.name}")
+                for orphan in self.shard_files(int(shard_file.stem)):
+                    orphan.unlink(missing_ok=True)
@@ -0,0 +1,95 @@
+# Pipelined ingest: download, encode and shard writing run at the same time.
+# Downloaded photos flow through a bounded queue into batched CLIP encoding, so the model works
+# while the network is busy and vice versa; time to a searchable index is roughly
+# max(download, encode) instead of their sum. When the encoder falls behind, the queue fills up
+# and the download threads block on it (backpressure), so memory stays bounded.
+import queue
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from data_downloader import download_data
+from data_processor import prefetch_batches, write_shard, finish_index
+from index_manifest import IndexManifest
+from thumbnails import DEFAULT_SIZES, DEFAULT_QUALITY
+
+# Marks the end of the download in the photo queue
+_DONE = object()
+
+
+def _batches_from_queue(photo_queue, batch_size, first_shard):
+    # Group queued photo paths into (shard, batch_files) until the producer is done
+    shard = first_shard
+    batch = []
+    while True:
+        photo_path = photo_queue.get()
+        if photo_path is _DONE:
+            break
+        batch.append(photo_path)
+        if len(batch) == batch_size:
+            yield shard, batch
+            shard += 1
+            batch = []
+    if batch:
+        yield shard, batch
+
+
+def pipelined_ingest(file_path="data", version="lite", batch_size=16, threads_count=16, queue_size=256,
+                     workers=4, queue_depth=4, build_ann_index=False, quantize=None,
+                     thumbnail_sizes=DEFAULT_SIZES, thumbnail_quality=DEFAULT_QUALITY, build_neighbor_graph=False,
+                     dedup_threshold=None):
+    """Download and index a dataset version in one pass; returns (photo_ids_file, features_file)"""
+    dataset_path = Path(file_path) / version
+    photos_path = dataset_path / "photos"
+    photo_metadata = pd.read_csv(dataset_path / "photos.tsv000", sep='\t', header=0,
+                                 usecols=['photo_id', 'photo_description'])
+    descriptions = dict(zip(photo_metadata['photo_id'], photo_metadata['photo_description'].fillna("")))
+
+    manifest = IndexManifest(dataset_path / "features")
+    manifest.remove_orphan_shards()
+    # Photos already on disk but not embedded (or changed) go first
+    photos = {photo_file.stem: photo_file.stat().st_mtime_ns for photo_file in photos_path.glob("*.jpg")}
+    pending_ids, removed_ids = manifest.plan(photos)
+    if removed_ids:
+        print(f"Tombstoning {len(removed_ids)} removed or changed photos")
+        manifest.tombstone(removed_ids)
+
+    photo_queue = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def produce():
+        try:
+            for photo_id in pending_ids:
+                photo_queue.put(photos_path / f"{photo_id}.jpg")
+            # put() blocks while the queue is full, which throttles the download threads
+            download_data(version=version, data_path=file_path, threads_count=threads_count,
+                          on_photo=lambda photo_id, photo_path: photo_queue.put(photo_path))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            photo_queue.put(_DONE)
+
+    producer = threading.Thread(target=produce, name="download", daemon=True)
+    producer.start()
+
+    encoded_count = 0
+    start_time = time.perf_counter()
+    first_shard = manifest.next_shard()
+    batches = _batches_from_queue(photo_queue, batch_size, first_shard)
+    for shard, batch_files, photo_futures in prefetch_batches(batches, workers, queue_depth):
+        try:
+            encoded_count += write_shard(manifest, shard, batch_files, photo_futures, descriptions)
+        except Exception as e:
+            print(f'Problem with batch {shard - first_shard}: {e}')
+        elapsed = time.perf_counter() - start_time
+        print(f"Encoded {encoded_count} photos ({encoded_count / elapsed:.1f} images/sec), "
+              f"{photo_queue.qsize()} waiting in the queue")
+    producer.join()
+    if errors:
+        print(f"Download stopped early: {errors[0]}")
+
+    return finish_index(manifest, file_path, version, bool(encoded_count or removed_ids),
+                        build_ann_index, quantize, thumbnail_sizes, thumbnail_quality, build_neighbor_graph,
+                        dedup_threshold)
@@ -0,0 +1,166 @@
+# BM25 inverted index over the photo descriptions, for keyword search and hybrid (lexical + CLIP)
+# ranking. Every term has a postings list of the photos (feature rows) whose description contains
+# it, stored compactly as a CSR layout: the ascending rows are delta-encoded as uint16 gaps (the
+# rare gap that does not fit is escaped into a uint32 overflow array) next to uint8 term
+# frequencies, about 3 bytes per posting in a few flat arrays that np.load reads in one go. Descriptions are the dataset's photo_description and
+# ai_description columns of photos.tsv000.
+import math
+import os
+import re
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from topk_scorer import select_topk
+
+# BM25 parameters: term frequency saturation and length normalisation
+K1 = 1.2
+B = 0.75
+# Reciprocal rank fusion constant; larger values flatten the contribution of the top ranks
+RRF_K = 60
+# Marks a gap stored in the overflow array
+ESCAPE = np.iinfo(np.uint16).max
+STOPWORDS = frozenset("a an and are as at be by for from in into is it of on or that the this to with".split())
+
+
+def lexical_index_path(features_file):
+    """The index is saved next to the features it is aligned with"""
+    return Path(features_file).with_name("lexical_index.npz")
+
+
+def tokenize(text):
+    return [term for term in re.findall(r"[a-z0-9]+", str(text).lower()) if term not in STOPWORDS]
+
+
+def required_terms(query):
+    """Terms of the "quoted" parts of a query, which a result must contain"""
+    return [term for phrase in re.findall(r'"([^"]*)"', query) for term in tokenize(phrase)]
+
+
+def reciprocal_rank_fusion(rankings, k, rrf_k=RRF_K):
+    """The k best items of several rankings, scored by the sum of 1 / (rrf_k + rank)"""
+    fused = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + 1.0 / (rrf_k + rank)
+    # Ties keep the order in which the items were first seen
+    return sorted(fused, key=fused.get, reverse=True)[:k]
+
+
+class LexicalIndex:
+    def __init__(self, terms, offsets, gaps, overflow, frequencies, lengths):
+        self.terms = terms
+        self.offsets = offsets
+        self.gaps = gaps
+        self.overflow = overflow
+        self.frequencies = frequencies
+        self.lengths = lengths
+        # Position in overflow of the first escaped gap of every term
+        escaped = np.concatenate([[0], np.cumsum(gaps == ESCAPE)])
+        self.overflow_offsets = escaped[offsets]
+        self.term_ids = {term: i for i, term in enumerate(terms.tolist())}
+        self.average_length = max(float(lengths.mean()), 1.0) if len(lengths) else 1.0
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @classmethod
+    def build(cls, documents):
+        """Index of a list of texts; the row of each text is its document ID"""
+        postings = {}
+        lengths = np.zeros(len(documents), dtype=np.uint16)
+        for row, document in enumerate(documents):
+            tokens = tokenize(document)
+            lengths[row] = min(len(tokens), np.iinfo(np.uint16).max)
+            for term, frequency in Counter(tokens).items():
+                postings.setdefault(term, []).append((row, frequency))
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        rows = np.empty(offsets[-1], dtype=np.int64)
+        frequencies = np.empty(offsets[-1], dtype=np.uint8)
+        for i, term in enumerate(terms):
+            term_rows, term_frequencies = zip(*postings[term])
+            rows[offsets[i]:offsets[i + 1]] = term_rows
+            frequencies[offsets[i]:offsets[i + 1]] = np.minimum(term_frequencies, 255)
+        # Delta-encode each postings list; the first entry of a list holds its absolute row
+        gaps = np.diff(rows, prepend=0)
+        gaps[offsets[:-1]] = rows[offsets[:-1]]
+        escaped = gaps >= ESCAPE
+        overflow = gaps[escaped].astype(np.uint32)
+        gaps[escaped] = ESCAPE
+        return cls(np.array(terms, dtype=str), offsets, gaps.astype(np.uint16), overflow, frequencies, lengths)
+
+    def save(self, path):
+        # Written then renamed, so a running search never loads a partial file
+        tmp_file = Path(path).with_name(f"{Path(path).stem}.tmp.npz")
+        np.savez(tmp_file, terms=self.terms, offsets=self.offsets, gaps=self.gaps, overflow=self.overflow,
+                 frequencies=self.frequencies, lengths=self.lengths)
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data["terms"], data["offsets"], data["gaps"], data["overflow"], data["frequencies"],
+                   data["lengths"])
+
+    def postings(self, term):
+        """(rows, term frequencies) of the documents containing term"""
+        i = self.term_ids.get(term)
+        if i is None:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        gaps = self.gaps[start:stop].astype(np.int64)
+        escaped = gaps == ESCAPE
+        if escaped.any():
+            overflow_start = self.overflow_offsets[i]
+            gaps[escaped] = self.overflow[overflow_start:overflow_start + escaped.sum()]
+        return np.cumsum(gaps), self.frequencies[start:stop]
+
+    def scores(self, query):
+        """Dense BM25 score of every document for the query's terms (0 where none matches)"""
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(query)):
+            rows, frequencies = self.postings(term)
+            if len(rows) == 0:
+                continue
+            idf = math.log(1 + (len(self) - len(rows) + 0.5) / (len(rows) + 0.5))
+            frequencies = frequencies.astype(np.float32)
+            norms = K1 * (1 - B + B * self.lengths[rows] / self.average_length)
+            scores[rows] += idf * frequencies * (K1 + 1) / (frequencies + norms)
+        return scores
+
+    def matching_rows(self, terms):
+        """Sorted rows of the documents containing every one of terms"""
+        rows = None
+        for term in set(terms):
+            term_rows, _ = self.postings(term)
+            rows = term_rows if rows is None else np.intersect1d(rows, term_rows, assume_unique=True)
+        return np.arange(len(self)) if rows is None else rows
+
+    def search(self, query, k, rows=None):
+        """(rows, scores) of the k best documents by BM25, only among rows when given"""
+        scores = self.scores(query)
+        candidates = np.flatnonzero(scores) if rows is None else rows[scores[rows] > 0]
+        best_scores, best_rows = select_topk(scores[candidates], candidates, k)
+        return best_rows, best_scores
+
+
+def build_lexical_index(photo_ids_file, features_file, photos_file=None):
+    """Index the descriptions of the photos of photo_ids_file, aligned with the rows of features_file"""
+    photo_ids = pd.read_csv(photo_ids_file, dtype={"photo_id": str}, keep_default_na=False)
+    if photos_file is not None and Path(photos_file).exists():
+        columns = ["photo_id", "photo_description", "ai_description"]
+        photos = pd.read_csv(photos_file, sep="\t", header=0, usecols=lambda column: column in columns)
+        photos = photos.drop_duplicates("photo_id").set_index("photo_id").reindex(photo_ids["photo_id"])
+        documents = photos.reindex(columns=columns[1:]).fillna("").astype(str).agg(" ".join, axis=1).tolist()
+    else:
+        # Only the description written next to photo_id during ingest
+        documents = photo_ids.get("description", pd.Series("", index=photo_ids.index)).astype(str).tolist()
+    index = LexicalIndex.build(documents)
+    index.save(lexical_index_path(features_file))
+    print(f"Lexical index of {len(index)} descriptions ({len(index.terms)} terms, "
+          f"{len(index.gaps)} postings) saved to {lexical_index_path(features_file)}")
+    return index
@@ -8,14 +8,12 @@
 # # Unfortunately, the CLIP code is not organized as a module, so it cannot be imported easily
 # !mv CLIP/*.py .
 # !mv CLIP/*.gz .
-from data_downloader import download_data
-from data_processor import process_data
-from model_image_search import image_search
+from ingest_pipeline import pipelined_ingest
+from model_image_search import get_search_engine
 from gemini_ranker import gemini_rank
+from thumbnails import get_thumbnail
 
 from pathlib import Path
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
 import math
 
 def main():
@@ -24,20 +22,24 @@ def main():
     version = "lite"
     feature_file = f"{file_path}/{version}/features/features.npy"
     if not Path(feature_file).exists():
-        photo_metadata = download_data(version="lite", data_path="data",threads_count=16)
-        photo_ids_file, photo_features_file = process_data(photo_metadata,file_path, version="lite", batch_size=16)
+        # Download and encode at the same time
+        photo_ids_file, photo_features_file = pipelined_ingest(file_path, version="lite", batch_size=16, threads_count=16)
     else:
         photo_ids_file = "data/lite/features/photo_ids.csv"
         photo_features_file = "data/lite/features/features.npy"
     results_count = 10
     results_count_final = 4
+    # Load the model and the features once, then reuse them for every query
+    search_engine = get_search_engine(photo_ids_file, photo_features_file)
     search_query = input("What picture you want to search?")
     # search_query = "two birds flying"
-    best_photo_ids_raw = image_search(photo_ids_file, photo_features_file, search_query, results_count)
+    best_photo_ids_raw = search_engine.search(search_query, results_count)
     image_ids = gemini_rank(best_photo_ids_raw,file_path,version,search_query,results_count_final)
     # print(best_photo_ids_raw)
 
     def display_photo(best_photo_ids,image_ids, rows=2):
+        import matplotlib.pyplot as plt
+        import matplotlib.image as mpimg
         if len(best_photo_ids) == 0 or len(image_ids) == 0:
             print("No images found!")
         else:
@@ -48,7 +50,7 @@ def main():
             for i, image_id in enumerate(image_ids):
                 photo_id = best_photo_ids[image_id-1]
                 print(photo_id)
-                photo_image_path = f"{file_path}/{version}/photos/{photo_id}.jpg"
+                photo_image_path = get_thumbnail(file_path, version, photo_id)
                 img = mpimg.imread(photo_image_path)
                 plt.subplot(display_rows, display_cols, i + 1)
                 plt.imshow(img)
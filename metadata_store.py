@@ -0,0 +1,200 @@
+# Columnar store of per-photo metadata from photos.tsv000, aligned with the rows of features.npy,
+# so searches can be restricted with a filter expression such as
+#     orientation == landscape and width >= 3000 and country in (Iceland, Norway)
+# Numeric columns are float32 arrays (NaN when missing), text columns are dictionary-encoded as
+# int32 codes into a categories array (-1 when missing). A filter becomes a boolean mask over the
+# rows; the mask of each clause and of each whole expression is cached, so a repeated filter costs
+# nothing and the search only scores the eligible rows.
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+NUMERIC_COLUMNS = ("photo_width", "photo_height", "photo_aspect_ratio", "exif_iso", "exif_focal_length",
+                   "exif_aperture_value", "photo_location_latitude", "photo_location_longitude",
+                   "stats_views", "stats_downloads")
+CATEGORICAL_COLUMNS = ("photo_featured", "photo_location_country", "photo_location_city", "exif_camera_make",
+                       "exif_camera_model", "photographer_username", "orientation")
+# Short names accepted in filter expressions
+ALIASES = {
+    "width": "photo_width",
+    "height": "photo_height",
+    "aspect_ratio": "photo_aspect_ratio",
+    "iso": "exif_iso",
+    "focal_length": "exif_focal_length",
+    "aperture": "exif_aperture_value",
+    "latitude": "photo_location_latitude",
+    "longitude": "photo_location_longitude",
+    "views": "stats_views",
+    "downloads": "stats_downloads",
+    "featured": "photo_featured",
+    "country": "photo_location_country",
+    "city": "photo_location_city",
+    "camera_make": "exif_camera_make",
+    "camera_model": "exif_camera_model",
+    "photographer": "photographer_username",
+}
+
+_CLAUSE = re.compile(r"^\s*(\w+)\s*(==|!=|>=|<=|>|<|=|\bin\b)\s*(.+?)\s*$", re.IGNORECASE)
+_OPERATORS = {"==": np.equal, "=": np.equal, "!=": np.not_equal, ">=": np.greater_equal,
+              "<=": np.less_equal, ">": np.greater, "<": np.less}
+
+
+def metadata_path(features_file):
+    """The metadata is saved next to the features it is aligned with"""
+    return Path(features_file).with_name("metadata.npz")
+
+
+def _orientation(aspect_ratio):
+    # Unsplash's aspect ratio is width / height
+    orientation = np.full(len(aspect_ratio), None, dtype=object)
+    orientation[aspect_ratio > 1.05] = "landscape"
+    orientation[aspect_ratio < 0.95] = "portrait"
+    orientation[(aspect_ratio >= 0.95) & (aspect_ratio <= 1.05)] = "square"
+    return orientation
+
+
+def _strip_quotes(value):
+    value = value.strip()
+    if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+        return value[1:-1]
+    return value
+
+
+def parse_filter(expression):
+    """[(column, operator, value or list of values)] of an expression of clauses joined by 'and'"""
+    clauses = []
+    # Split on "and" outside quotes, so country == "Trinidad and Tobago" stays one clause
+    for clause in re.split(r"\s+and\s+(?=(?:[^'\"]*['\"][^'\"]*['\"])*[^'\"]*$)", expression.strip(),
+                           flags=re.IGNORECASE):
+        match = _CLAUSE.match(clause)
+        if match is None:
+            raise ValueError(f"Cannot parse filter clause {clause!r}, expected e.g. 'width >= 3000'")
+        column, operator, value = match.groups()
+        column = ALIASES.get(column.lower(), column.lower())
+        if column not in NUMERIC_COLUMNS and column not in CATEGORICAL_COLUMNS:
+            raise ValueError(f"Unknown filter column {column!r}")
+        operator = operator.lower()
+        if operator == "in":
+            value = [_strip_quotes(v) for v in value.strip().strip("()[]").split(",") if v.strip()]
+        else:
+            value = _strip_quotes(value)
+        clauses.append((column, operator, value))
+    return clauses
+
+
+class MetadataStore:
+    def __init__(self, columns, mask_cache_size=256):
+        # Numeric name -> float32 array; categorical name -> (int32 codes, categories)
+        self.columns = columns
+        self.mask_cache_size = mask_cache_size
+        self._masks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))[0]) if self.columns else 0
+
+    @classmethod
+    def build(cls, photos, photo_ids):
+        """Columns of the photos table (a DataFrame of photos.tsv000) in the order of photo_ids"""
+        photos = photos.drop_duplicates("photo_id").set_index("photo_id").reindex(photo_ids)
+        columns = {}
+        for column in NUMERIC_COLUMNS:
+            values = photos[column] if column in photos else pd.Series(np.nan, index=photos.index)
+            # EXIF fields are free text in the dump, anything that is not a number becomes NaN
+            columns[column] = (pd.to_numeric(values, errors="coerce").to_numpy(dtype=np.float32),)
+        aspect_ratio = columns["photo_aspect_ratio"][0]
+        for column in CATEGORICAL_COLUMNS:
+            if column == "orientation":
+                values = pd.Series(_orientation(aspect_ratio))
+            elif column in photos:
+                values = photos[column].astype("string")
+            else:
+                values = pd.Series([None] * len(photos), dtype="string")
+            codes, categories = pd.factorize(values)
+            columns[column] = (codes.astype(np.int32), np.asarray(categories, dtype=str))
+        return cls(columns)
+
+    def save(self, path):
+        arrays = {}
+        for column, values in self.columns.items():
+            if column in NUMERIC_COLUMNS:
+                arrays[column] = values[0]
+            else:
+                arrays[f"{column}.codes"], arrays[f"{column}.categories"] = values
+        # Written then renamed, so a running search never loads a partial file
+        tmp_file = Path(path).with_name(f"{Path(path).stem}.tmp.npz")
+        np.savez(tmp_file, **arrays)
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path, **options):
+        data = np.load(path)
+        columns = {}
+        for column in NUMERIC_COLUMNS:
+            if column in data:
+                columns[column] = (data[column],)
+        for column in CATEGORICAL_COLUMNS:
+            if f"{column}.codes" in data:
+                columns[column] = (data[f"{column}.codes"], data[f"{column}.categories"])
+        return cls(columns, **options)
+
+    def _cached(self, key, compute):
+        with self._lock:
+            if key in self._masks:
+                self._masks.move_to_end(key)
+                return self._masks[key]
+        mask = compute()
+        with self._lock:
+            self._masks[key] = mask
+            while len(self._masks) > self.mask_cache_size:
+                self._masks.popitem(last=False)
+        return mask
+
+    def _clause_mask(self, column, operator, value):
+        if column not in self.columns:
+            raise ValueError(f"No {column!r} column in the metadata")
+        if column in NUMERIC_COLUMNS:
+            values = self.columns[column][0]
+            if operator == "in":
+                return np.isin(values, [float(v) for v in value])
+            return _OPERATORS[operator](values, float(value))
+        codes, categories = self.columns[column]
+        if operator not in ("==", "=", "!=", "in"):
+            raise ValueError(f"Operator {operator!r} is not supported on the text column {column!r}")
+        # Text values match case-insensitively; the comparison runs on the small categories array
+        wanted = {v.lower() for v in (value if operator == "in" else [value])}
+        matching = np.flatnonzero([category.lower() in wanted for category in categories])
+        mask = np.isin(codes, matching)
+        return ~mask if operator == "!=" else mask
+
+    def mask(self, expression):
+        """Boolean mask of the rows matching the filter expression"""
+        clauses = parse_filter(expression)
+
+        def compute():
+            mask = np.ones(len(self), dtype=bool)
+            for column, operator, value in clauses:
+                key = (column, operator, tuple(value) if isinstance(value, list) else value)
+                mask &= self._cached(key, lambda: self._clause_mask(column, operator, value))
+            return mask
+
+        return self._cached(" and ".join(f"{c} {o} {v}" for c, o, v in clauses), compute)
+
+    def rows(self, expression):
+        """Sorted indices of the rows matching the filter expression"""
+        return np.flatnonzero(self.mask(expression))
+
+
+def build_metadata(photos_file, photo_ids_file, features_file):
+    """Write metadata.npz next to features_file, aligned with the rows of photo_ids_file"""
+    photos = pd.read_csv(photos_file, sep="\t", header=0, low_memory=False)
+    photo_ids = pd.read_csv(photo_ids_file)["photo_id"]
+    store = MetadataStore.build(photos, photo_ids)
+    store.save(metadata_path(features_file))
+    print(f"Metadata of {len(store)} photos saved to {metadata_path(features_file)}")
+    return store
@@ -0,0 +1,155 @@
+# Per-stage latency metrics for the search -> rerank -> render pipeline.
+# Code is wrapped in `with span("stage"):` blocks; every span is added to a latency histogram for
+# its stage, logged as one JSON line on the "image_search.metrics" logger, and recorded in the
+# calling thread's current trace, so a UI can show where the time of the last query went:
+#     with trace() as stages:
+#         ...
+#     print(format_breakdown(stages))
+# Histograms and counters are served in the Prometheus text format by start_metrics_server().
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "image_search"
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+logger = logging.getLogger("image_search.metrics")
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+
+_histograms = {}
+_counters = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+
+def observe(stage, seconds):
+    """Record seconds spent in stage: histogram, current trace and structured log"""
+    with _lock:
+        if stage not in _histograms:
+            _histograms[stage] = Histogram()
+        _histograms[stage].observe(seconds)
+    stages = getattr(_local, "stages", None)
+    if stages is not None:
+        # A stage entered several times in one trace is summed
+        stages[stage] = stages.get(stage, 0.0) + seconds
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(json.dumps({"event": "span", "stage": stage, "seconds": round(seconds, 6),
+                                "thread": threading.current_thread().name}))
+
+
+def count(name, value=1, **labels):
+    """Increment the counter name (exported as <prefix>_<name>_total) with the given labels"""
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+@contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def trace():
+    """Collect the stages run by this thread into a dict of stage -> seconds, plus "total" """
+    stages = {}
+    previous = getattr(_local, "stages", None)
+    _local.stages = stages
+    start = time.perf_counter()
+    try:
+        yield stages
+    finally:
+        stages["total"] = time.perf_counter() - start
+        _local.stages = previous
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps({"event": "trace", "stages": {k: round(v, 6) for k, v in stages.items()}}))
+
+
+def current_trace():
+    # The stages dict of the active trace of this thread, or None
+    return getattr(_local, "stages", None)
+
+
+def format_breakdown(stages):
+    """One-line summary of a trace, e.g. 'encode_text 12ms · score 38ms · total 55ms'"""
+    parts = [f"{stage} {seconds * 1000:.0f}ms" for stage, seconds in stages.items() if stage != "total"]
+    if "total" in stages:
+        parts.append(f"total {stages['total'] * 1000:.0f}ms")
+    return " · ".join(parts)
+
+
+def _labels(pairs):
+    return ",".join(f'{name}="{value}"' for name, value in pairs)
+
+
+def render_prometheus():
+    """All histograms and counters in the Prometheus text exposition format"""
+    with _lock:
+        histograms = {stage: (list(h.counts), h.count, h.sum, h.buckets) for stage, h in _histograms.items()}
+        counters = dict(_counters)
+    lines = [f"# HELP {PREFIX}_stage_seconds Time spent in each stage of the search pipeline",
+             f"# TYPE {PREFIX}_stage_seconds histogram"]
+    for stage, (counts, total_count, total_sum, buckets) in sorted(histograms.items()):
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {total_count}')
+        lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {total_sum}')
+        lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {total_count}')
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        for (counter_name, labels), value in sorted(counters.items()):
+            if counter_name == name:
+                label_text = f"{{{_labels(labels)}}}" if labels else ""
+                lines.append(f"{PREFIX}_{name}_total{label_text} {value}")
+    return "\n".join(lines) + "\n"
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a line on stderr each
+        pass
+
+
+def start_metrics_server(port=9100, host="0.0.0.0"):
+    """Serve /metrics from a daemon thread; returns the server (call shutdown() to stop it)"""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    print(f"Metrics available at http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -1,56 +1,416 @@
-import clip
-import torch
+import threading
+
 import pandas as pd
 import numpy as np
 
+from ann_index import IVFIndex, index_path
+from dedup import duplicates_path, load_representatives
+from feature_store import FeatureStore
+from lexical_index import LexicalIndex, RRF_K, lexical_index_path, reciprocal_rank_fusion, required_terms
+from metadata_store import MetadataStore, metadata_path
+from metrics import count, span
+from neighbor_graph import NeighborGraph, graph_paths
+from quantization import QuantizedCodes, codes_path
+from query_cache import EmbeddingCache
+from sharded_search import ShardedSearcher
+from topk_scorer import DEFAULT_BLOCK_SIZE
+
+
+def _matches_index(path, rows, photos_count):
+    # Files derived from features.npy are only usable while they have one row per indexed photo;
+    # one left over from before an incremental update would point at the wrong photos
+    if rows != photos_count:
+        print(f"Ignoring {path}: it has {rows} rows but the index has {photos_count} photos, "
+              f"rebuild it with process_data()")
+        return False
+    return True
+
+
+class SearchEngine:
+    """Loads the CLIP model, the photo IDs and the feature matrix once and answers queries"""
+
+    def __init__(self, photo_ids_file, photo_features_file, model_name="ViT-B/32", device=None,
+                 block_size=DEFAULT_BLOCK_SIZE, use_index=False, nprobe=8, quantization=None,
+                 rescore_factor=10, cache_size=1024, cache_file=None, shards=None, replication=1,
+                 text_only=False, quantize_text=False, torchscript=False, threads=None, collapse_duplicates=False,
+                 resident_features=False, shard_addresses=None, shard_authkey=None, allow_partial=True):
+        # The open CLIP model is loaded on the first query that misses the cache
+        self.device = device
+        self.model_name = model_name
+        # Query serving only needs the text tower: text_only loads just that on CPU, optionally int8/TorchScript
+        self.text_only = text_only
+        self.quantize_text = quantize_text
+        self.torchscript = torchscript
+        self.threads = threads
+        self._model = None
+        self._model_lock = threading.Lock()
+        # Load the Precomputed Data
+        photo_ids = pd.read_csv(photo_ids_file)
+        self.photo_ids = list(photo_ids['photo_id'])
+        # Memory-map the float16 features vectors, they are scored block by block in float32;
+        # resident_features keeps a float32 copy in memory instead, faster when it fits
+        self.feature_store = FeatureStore(photo_features_file, block_size, resident_features)
+        self.photo_features = self.feature_store.features
+        if len(self.photo_features) != len(self.photo_ids):
+            raise ValueError(f"{photo_features_file} has {len(self.photo_features)} rows but {photo_ids_file} "
+                             f"has {len(self.photo_ids)} photos")
+        # Optional IVF index built by process_data(build_ann_index=True), exact search otherwise
+        self.ann_index = None
+        if use_index:
+            if index_path(photo_features_file).exists():
+                self.ann_index = IVFIndex.load(index_path(photo_features_file), nprobe)
+                if not _matches_index(index_path(photo_features_file), len(self.ann_index.list_ids),
+                                      len(self.photo_ids)):
+                    self.ann_index = None
+            else:
+                print(f"No ANN index at {index_path(photo_features_file)}, using exact search")
+        # Optional int8/binary codes built by process_data(quantize=...), rescored against the store
+        self.quantized_codes = None
+        if quantization is not None:
+            if codes_path(photo_features_file, quantization).exists():
+                self.quantized_codes = QuantizedCodes.load(codes_path(photo_features_file, quantization),
+                                                           rescore_factor=rescore_factor, block_size=block_size)
+                if not _matches_index(codes_path(photo_features_file, quantization),
+                                      len(self.quantized_codes.codes), len(self.photo_ids)):
+                    self.quantized_codes = None
+            else:
+                print(f"No {quantization} codes at {codes_path(photo_features_file, quantization)}, using exact search")
+        # Optional pool of shard worker processes for the exact search, local (shards) or remote
+        # (shard_addresses, one list of replica addresses per shard, and the workers' shard_authkey)
+        self.sharded_searcher = None
+        if shards or shard_addresses:
+            self.sharded_searcher = ShardedSearcher(photo_features_file, shards, replication, shard_addresses,
+                                                    shard_authkey, block_size=block_size, allow_partial=allow_partial)
+        # Optional near-duplicate clusters from dedup.find_duplicates(), one photo per cluster is shown
+        self.representatives = None
+        if collapse_duplicates:
+            if duplicates_path(photo_features_file).exists():
+                self.representatives = load_representatives(photo_features_file)
+                if not _matches_index(duplicates_path(photo_features_file), len(self.representatives),
+                                      len(self.photo_ids)):
+                    self.representatives = None
+            else:
+                print(f"No duplicate clusters at {duplicates_path(photo_features_file)}, showing every photo")
+        # Encoded queries, LRU-bounded and optionally persisted to cache_file
+        self.query_cache = EmbeddingCache(cache_size, cache_file)
+        # Photo metadata for filtered searches, loaded on the first filter
+        self.photo_features_file = photo_features_file
+        self._metadata = None
+        # BM25 index of the descriptions for lexical and hybrid search, loaded on first use
+        self._lexical_index = None
+        # Precomputed neighbours for more_like_this(), memory-mapped on first use when built
+        self._neighbor_graph = None
+        self._photo_index = None
+        # Print some statistics
+        print(f"Photos loaded: {len(self.photo_ids)}")
+
+    def load_model(self):
+        with self._model_lock:
+            if self._model is None:
+                with span("model_load"):
+                    self._model = self._load_model()
+            return self._model
+
+    def _load_model(self):
+        import clip
+        import torch
+        if self.text_only:
+            from text_encoder import load_text_encoder
+            self.device = "cpu"
+            return load_text_encoder(self.model_name, self.quantize_text, self.torchscript, self.threads), None
+        if self.threads:
+            torch.set_num_threads(self.threads)
+        self.device = self.device or ("cuda" if torch.cuda.is_available() else "cpu")
+        return clip.load(self.model_name, device=self.device)
+
+    @property
+    def model(self):
+        return self.load_model()[0]
+
+    @property
+    def encoder_name(self):
+        """Model and encoder variant, e.g. "ViT-B/32/text-int8-jit": the variants' embeddings differ slightly"""
+        if not self.text_only:
+            return self.model_name
+        return f"{self.model_name}/text-{'int8' if self.quantize_text else 'fp32'}{'-jit' if self.torchscript else ''}"
+
+    @property
+    def preprocess(self):
+        return self.load_model()[1]
+
+    def encode_search_query(self, search_query):
+        import clip
+        import torch
+        model = self.model
+        # A single string or a list of strings, encoded in one forward pass
+        with span("encode_text"), torch.no_grad():
+            # Encode and normalize the search query using CLIP
+            text_encoded = model.encode_text(clip.tokenize(search_query).to(self.device))
+            text_encoded /= text_encoded.norm(dim=-1, keepdim=True)
+        # Retrieve the feature vector
+        return text_encoded
+
+    def encode_image(self, image):
+        """(1, D) float32 features of an image (a path or a PIL image), like the photo features"""
+        import torch
+        from PIL import Image
+        if self.text_only:
+            raise ValueError("Image queries need the image tower, create the engine with text_only=False")
+        model, preprocess = self.load_model()
+        if not isinstance(image, Image.Image):
+            image = Image.open(image)
+        with span("encode_image"), torch.no_grad():
+            image_encoded = model.encode_image(preprocess(image.convert("RGB")).unsqueeze(0).to(self.device))
+            image_encoded /= image_encoded.norm(dim=-1, keepdim=True)
+        return image_encoded.cpu().numpy().astype(np.float32)
+
+    def encode_queries(self, queries):
+        """(Q, D) float32 query features, encoding only the queries missing from the cache"""
+        cached = [self.query_cache.get(self.encoder_name, query) for query in queries]
+        missing = [query for query, embedding in zip(queries, cached) if embedding is None]
+        count("query_cache_lookups", len(queries) - len(missing), result="hit")
+        count("query_cache_lookups", len(missing), result="miss")
+        if missing:
+            encoded = iter(self.encode_search_query(missing).cpu().numpy().astype(np.float32))
+            for i, query in enumerate(queries):
+                if cached[i] is None:
+                    cached[i] = next(encoded)
+                    self.query_cache.put(self.encoder_name, query, cached[i])
+        return np.stack(cached)
+
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            path = metadata_path(self.photo_features_file)
+            if not path.exists():
+                raise ValueError(f"No metadata at {path}, filters need process_data() with photos.tsv000")
+            metadata = MetadataStore.load(path)
+            if not _matches_index(path, len(metadata), len(self.photo_ids)):
+                raise ValueError(f"The metadata at {path} is out of date, run process_data() to rebuild it")
+            self._metadata = metadata
+        return self._metadata
+
+    def filter_rows(self, filter):
+        """Sorted indices of the photos matching a filter expression, e.g. 'orientation == portrait'"""
+        with span("filter"):
+            return self.metadata.rows(filter)
+
+    def _best_indices(self, text_features, results_count, rows=None):
+        # (Q, <= results_count) photo indices from the configured backend, padded with -1
+        if rows is not None:
+            # Filtered: only the eligible rows are scored, exactly, so it gets faster as the filter narrows
+            backend = "filtered"
+            best_photo_idx, _ = self.feature_store.topk(text_features, results_count, rows)
+        elif self.quantized_codes is not None:
+            backend = "quantized"
+            with span("score"):
+                best_photo_idx, _ = self.quantized_codes.search(self.photo_features, text_features, results_count)
+        elif self.ann_index is not None:
+            backend = "ivf"
+            with span("score"):
+                best_photo_idx, _ = self.ann_index.search(self.photo_features, text_features, results_count)
+        elif self.sharded_searcher is not None:
+            backend = "sharded"
+            with span("score"):
+                best_photo_idx, _ = self.sharded_searcher.search(text_features, results_count)
+        else:
+            # Reports its own "score" and "topk" stages
+            backend = "exact"
+            best_photo_idx, _ = self.feature_store.topk(text_features, results_count)
+        count("queries", len(text_features), backend=backend)
+        return best_photo_idx
+
+    def _collapsed_indices(self, text_features, results_count, rows=None):
+        # Over-fetch and keep the best-ranked photo of each duplicate cluster; fetch more while
+        # that leaves fewer than results_count and the backend has more to give
+        fetch = results_count * 2
+        while True:
+            best_photo_idx = self._best_indices(text_features, fetch, rows)
+            collapsed = []
+            for row in best_photo_idx:
+                seen = set()
+                kept = []
+                for i in row:
+                    if i >= 0 and self.representatives[i] not in seen:
+                        seen.add(self.representatives[i])
+                        kept.append(i)
+                        if len(kept) == results_count:
+                            break
+                collapsed.append(kept)
+            if best_photo_idx.shape[1] < fetch or all(len(kept) == results_count for kept in collapsed):
+                return collapsed
+            fetch *= 4
+
+    def find_best_matches_batch(self, text_features, results_count=5, rows=None):
+        # Compute the Cosine similarity of every query block by block, keeping only a running top-k
+        if hasattr(text_features, "cpu"):
+            # torch tensor
+            text_features = text_features.cpu().numpy()
+        text_features = np.asarray(text_features, dtype=np.float32)
+        if self.representatives is None:
+            best_photo_idx = self._best_indices(text_features, results_count, rows)
+        else:
+            best_photo_idx = self._collapsed_indices(text_features, results_count, rows)
+        # Return the photo IDs of the best matches of each query
+        return [[self.photo_ids[i] for i in row if i >= 0] for row in best_photo_idx]
+
+    def find_best_matches(self, text_features, results_count=5, rows=None):
+        return self.find_best_matches_batch(text_features, results_count, rows)[0]
+
+    def search(self, query, k=5, filter=None):
+        if len(query) == 0:
+            print("Please enter your search query")
+        rows = self.filter_rows(filter) if filter else None
+        if rows is not None and len(rows) == 0:
+            return []
+        # Encode the search query, or reuse its cached features
+        text_features = self.encode_queries([query])
+        # Find the best matches
+        return self.find_best_matches(text_features, k, rows)
+
+    @property
+    def lexical_index(self):
+        if self._lexical_index is None:
+            path = lexical_index_path(self.photo_features_file)
+            if not path.exists():
+                raise ValueError(f"No lexical index at {path}, run process_data() to build it")
+            lexical_index = LexicalIndex.load(path)
+            if not _matches_index(path, len(lexical_index), len(self.photo_ids)):
+                raise ValueError(f"The lexical index at {path} is out of date, run process_data() to rebuild it")
+            self._lexical_index = lexical_index
+        return self._lexical_index
+
+    def _lexical_rows(self, query, filter=None):
+        # Rows allowed by the filter and by the "quoted" terms of the query, None when unrestricted
+        rows = self.filter_rows(filter) if filter else None
+        required = required_terms(query)
+        if required:
+            # Exact-term query: the postings narrow the candidates before any CLIP scoring
+            with span("lexical_narrow"):
+                matching = self.lexical_index.matching_rows(required)
+            rows = matching if rows is None else np.intersect1d(rows, matching, assume_unique=True)
+        return rows
+
+    def lexical_search(self, query, k=5, filter=None):
+        """Photos ranked by BM25 over their descriptions"""
+        rows = self._lexical_rows(query, filter)
+        with span("lexical"):
+            best_rows, _ = self.lexical_index.search(query, k, rows)
+        count("queries", backend="lexical")
+        return [self.photo_ids[i] for i in best_rows]
+
+    def hybrid_search(self, query, k=5, filter=None, depth=100, rrf_k=RRF_K):
+        """CLIP and BM25 rankings of the top depth photos, merged by reciprocal rank fusion.
+
+        Words in "double quotes" must appear in the description of every result.
+        """
+        rows = self._lexical_rows(query, filter)
+        if rows is not None and len(rows) == 0:
+            return []
+        with span("lexical"):
+            lexical_rows, _ = self.lexical_index.search(query, depth, rows)
+        text_features = self.encode_queries([" ".join(query.replace('"', " ").split())])
+        clip_ranking = self.find_best_matches(text_features, depth, rows)
+        with span("fusion"):
+            return reciprocal_rank_fusion([clip_ranking, [self.photo_ids[i] for i in lexical_rows]], k, rrf_k)
+
+    def search_by_image(self, image, k=5, filter=None):
+        """Photos most similar to an uploaded image (a path or a PIL image)"""
+        rows = self.filter_rows(filter) if filter else None
+        if rows is not None and len(rows) == 0:
+            return []
+        return self.find_best_matches(self.encode_image(image), k, rows)
+
+    @property
+    def neighbor_graph(self):
+        if self._neighbor_graph is None and graph_paths(self.photo_features_file)[0].exists():
+            graph = NeighborGraph.load(self.photo_features_file)
+            # A stale graph is ignored (False, so it is only checked once) and more_like_this() scans
+            stale = not _matches_index(graph_paths(self.photo_features_file)[0], len(graph.neighbors),
+                                       len(self.photo_ids))
+            self._neighbor_graph = False if stale else graph
+        return self._neighbor_graph or None
+
+    def photo_index(self, photo_id):
+        if self._photo_index is None:
+            self._photo_index = {photo_id: i for i, photo_id in enumerate(self.photo_ids)}
+        if photo_id not in self._photo_index:
+            raise ValueError(f"Unknown photo ID {photo_id!r}")
+        return self._photo_index[photo_id]
+
+    def more_like_this(self, photo_id, k=5, filter=None):
+        """Photos most similar to an indexed photo, the photo itself excluded"""
+        index = self.photo_index(photo_id)
+        graph = self.neighbor_graph
+        if graph is not None and k <= graph.k and not filter:
+            if self.representatives is None:
+                # O(k) read of the precomputed neighbours
+                neighbors, _ = graph.neighbors_of(index, k)
+            else:
+                # Like the scan: the photo's own cluster is left out and each other cluster shows once
+                neighbors, _ = graph.neighbors_of(index)
+                seen = {self.representatives[index]}
+                kept = []
+                for i in neighbors:
+                    if self.representatives[i] not in seen:
+                        seen.add(self.representatives[i])
+                        kept.append(i)
+                neighbors = kept
+            if len(neighbors) >= k:
+                count("more_like_this", source="graph")
+                return [self.photo_ids[i] for i in neighbors[:k]]
+        # No graph (or a filter, more neighbours than it holds, or too many duplicates among them):
+        # scan with the photo's own features
+        count("more_like_this", source="scan")
+        rows = self.filter_rows(filter) if filter else None
+        if rows is not None:
+            rows = rows[rows != index]
+            if len(rows) == 0:
+                return []
+        best = self.find_best_matches(self.feature_store.rows([index]), k + 1, rows)
+        if self.representatives is not None:
+            # The results hold at most one photo of the photo's own cluster, which is dropped
+            own = self.representatives[index]
+            return [other for other in best if self.representatives[self.photo_index(other)] != own][:k]
+        return [other for other in best if other != photo_id][:k]
+
+    def search_batch(self, queries, k=5, batch_size=256, filter=None):
+        """Ranked photo IDs for each query: one encode_text call and one matrix product per batch"""
+        rows = self.filter_rows(filter) if filter else None
+        if rows is not None and len(rows) == 0:
+            return [[] for _ in queries]
+        results = []
+        # Batches bound the size of the (queries x block) similarity matrix and the encoder input
+        for start in range(0, len(queries), batch_size):
+            text_features = self.encode_queries(list(queries[start:start + batch_size]))
+            results.extend(self.find_best_matches_batch(text_features, k, rows))
+        return results
+
+
+# One engine per (ids, features) pair, shared by every caller in the process
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_search_engine(photo_ids_file, photo_features_file, **options):
+    # repr, so list options such as shard_addresses can be part of the key
+    key = (str(photo_ids_file), str(photo_features_file), tuple(sorted((k, repr(v)) for k, v in options.items())))
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = SearchEngine(photo_ids_file, photo_features_file, **options)
+        return _engines[key]
+
+
+def image_search(photo_ids_file, photo_features_file, search_query, results_count, filter=None, **options):
+    return get_search_engine(photo_ids_file, photo_features_file, **options).search(search_query, results_count,
+                                                                                    filter)
 
 
-def image_search(photo_ids_file, photo_features_file,search_query,results_count):
-
-    # Load the open CLIP model
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, preprocess = clip.load("ViT-B/32", device=device)
-    # Download the Precomputed Data
-    photo_ids = pd.read_csv(photo_ids_file)
-    photo_ids = list(photo_ids['photo_id'])
-    # Load the features vectors
-    photo_features = np.load(photo_features_file)
-
-    # Convert features to Tensors: Float32 on CPU and Float16 on GPU
-    if device == "cpu":
-      photo_features = torch.from_numpy(photo_features).float().to(device)
-    else:
-      photo_features = torch.from_numpy(photo_features).to(device)
-    # Print some statistics
-    print(f"Photos loaded: {len(photo_ids)}")
-    search_query = search_query
-    if len(search_query) == 0:
-        print("Please enter your search query")
-
-    def encode_search_query(search_query):
-      with torch.no_grad():
-        # Encode and normalize the search query using CLIP
-        text_encoded = model.encode_text(clip.tokenize(search_query).to(device))
-        text_encoded /= text_encoded.norm(dim=-1, keepdim=True)
-      # Retrieve the feature vector
-      return text_encoded
-
-    def find_best_matches(text_features, photo_features, photo_ids, results_count=5):
-      # Compute the similarity between the search query and each photo using the Cosine similarity
-      similarities = (photo_features @ text_features.T).squeeze(1)
-      # Sort the photos by their similarity score
-      best_photo_idx = (-similarities).argsort()
-      # Return the photo IDs of the best matches
-      return [photo_ids[i] for i in best_photo_idx[:results_count]]
-
-
-      # Encode the search query
-    text_features = encode_search_query(search_query)
-      # Find the best matches
-    best_photo_ids = find_best_matches(text_features, photo_features, photo_ids, results_count)
-    return best_photo_ids
+def image_search_batch(photo_ids_file, photo_features_file, search_queries, results_count, filter=None, **options):
+    return get_search_engine(photo_ids_file, photo_features_file, **options).search_batch(
+        search_queries, results_count, filter=filter)
 
 
 # search_query = "Two birds flying above the water"
 #
-# search_unslash(search_query, photo_features, photo_ids, 3)
\ No newline at end of file
+# search_unslash(search_query, photo_features, photo_ids, 3)
@@ -0,0 +1,115 @@
+# Precomputed k-nearest-neighbour graph of the photos, for "more like this" lookups.
+# Every photo's k most similar photos (by CLIP image feature) are computed offline with blocked
+# matrix multiplies: a block of query rows against one block of the corpus at a time, keeping a
+# running top-k per row, so memory stays at (query block x corpus block) scores. The graph is two
+# memory-mapped arrays next to the features, so a lookup reads k entries instead of scanning N rows.
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+
+from topk_scorer import DEFAULT_BLOCK_SIZE, select_topk
+
+DEFAULT_NEIGHBORS = 32
+QUERY_BLOCK_SIZE = 1024
+
+
+def graph_paths(features_file):
+    """(neighbors, scores) files, saved next to the features the graph was built from"""
+    features_file = Path(features_file)
+    return features_file.with_name("knn_neighbors.npy"), features_file.with_name("knn_scores.npy")
+
+
+def _block_neighbors(features, start, stop, k, block_size):
+    # Top-k neighbours of rows start:stop, the photo itself excluded, with the select_topk order:
+    # highest score first and lowest index on ties, so the graph agrees with a scan
+    queries = np.asarray(features[start:stop], dtype=np.float32)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    best_ids = np.empty((len(queries), 0), dtype=np.int64)
+    for block_start in range(0, features.shape[0], block_size):
+        block = np.asarray(features[block_start:block_start + block_size], dtype=np.float32)
+        scores = queries @ block.T
+        # A photo is not its own neighbour
+        own = np.arange(max(start, block_start), min(stop, block_start + len(block)))
+        scores[own - start, own - block_start] = -np.inf
+        ids = np.broadcast_to(np.arange(block_start, block_start + len(block)), scores.shape)
+        scores = np.concatenate([best_scores, scores], axis=1)
+        ids = np.concatenate([best_ids, ids], axis=1)
+        if scores.shape[1] > k:
+            keep = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            kept_scores = np.take_along_axis(scores, keep, axis=1)
+            kept_ids = np.take_along_axis(ids, keep, axis=1)
+            # argpartition splits the ties on the kth score arbitrarily; the few rows where it had
+            # to choose are selected again with the lowest indices winning
+            kth = kept_scores.min(axis=1, keepdims=True)
+            split = np.flatnonzero((scores == kth).sum(axis=1) > (kept_scores == kth).sum(axis=1))
+            for row in split:
+                kept_scores[row], kept_ids[row] = select_topk(scores[row], ids[row], k)
+            scores, ids = kept_scores, kept_ids
+        best_scores, best_ids = scores, ids
+    order = np.lexsort((best_ids, -best_scores), axis=1)
+    return np.take_along_axis(best_ids, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def _build_block(features, neighbors, scores, k, block_size, query_block_size, start):
+    # Fill the graph rows of one query block; runs on the worker threads
+    stop = min(start + query_block_size, len(neighbors))
+    neighbors[start:stop], scores[start:stop] = _block_neighbors(features, start, stop, k, block_size)
+
+
+def build_knn_graph(features_file, k=DEFAULT_NEIGHBORS, block_size=DEFAULT_BLOCK_SIZE,
+                    query_block_size=QUERY_BLOCK_SIZE, threads_count=4):
+    """Compute and save the k nearest neighbours of every photo of a features.npy"""
+    features = np.load(features_file, mmap_mode="r")
+    total = features.shape[0]
+    k = min(k, total - 1)
+    neighbors_file, scores_file = graph_paths(features_file)
+    tmp_neighbors_file = neighbors_file.with_name("knn_neighbors.tmp.npy")
+    tmp_scores_file = scores_file.with_name("knn_scores.tmp.npy")
+    neighbors = np.lib.format.open_memmap(tmp_neighbors_file, mode="w+", dtype=np.int32, shape=(total, k))
+    scores = np.lib.format.open_memmap(tmp_scores_file, mode="w+", dtype=np.float16, shape=(total, k))
+
+    # numpy releases the GIL in the matrix products and the selections, so query blocks run in parallel
+    build = partial(_build_block, features, neighbors, scores, k, block_size, query_block_size)
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads_count) as executor:
+        list(executor.map(build, range(0, total, query_block_size)))
+    neighbors.flush()
+    scores.flush()
+    # Unmapped before the rename
+    del build, neighbors, scores
+    os.replace(tmp_neighbors_file, neighbors_file)
+    os.replace(tmp_scores_file, scores_file)
+    print(f"{k}-NN graph of {total} photos saved to {neighbors_file} in {time.perf_counter() - start_time:.1f}s")
+    return neighbors_file
+
+
+class NeighborGraph:
+    def __init__(self, neighbors, scores):
+        self.neighbors = neighbors
+        self.scores = scores
+
+    @classmethod
+    def load(cls, features_file):
+        neighbors_file, scores_file = graph_paths(features_file)
+        return cls(np.load(neighbors_file, mmap_mode="r"), np.load(scores_file, mmap_mode="r"))
+
+    @property
+    def k(self):
+        return self.neighbors.shape[1]
+
+    def neighbors_of(self, index, k=None):
+        """(indices, scores) of the k most similar photos of photo index, most similar first"""
+        k = self.k if k is None else k
+        return np.asarray(self.neighbors[index, :k], dtype=np.int64), np.asarray(self.scores[index, :k], dtype=np.float32)
+
+
+if __name__ == "__main__":
+    # python neighbor_graph.py data/lite/features/features.npy [k]
+    import sys
+
+    features_file = sys.argv[1] if len(sys.argv) > 1 else "data/lite/features/features.npy"
+    build_knn_graph(features_file, int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_NEIGHBORS)
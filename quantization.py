@@ -0,0 +1,156 @@
+# Compressed copies of the CLIP photo features for a cheap first search pass.
+#   int8:   symmetric per-dimension scalar quantization, 1 byte per value (4x smaller than float32)
+#   binary: sign bits packed 8 per byte, compared by Hamming distance (32x smaller than float32)
+# Only the codes are held in RAM. The first pass picks a shortlist of rescore_factor * k photos from
+# the codes, then the shortlist is rescored exactly against the memory-mapped full-precision store.
+import time
+from pathlib import Path
+
+import numpy as np
+
+from topk_scorer import blockwise_topk, select_topk, DEFAULT_BLOCK_SIZE
+
+QUANTIZATION_KINDS = ("int8", "binary")
+
+# Number of set bits of every byte value, for Hamming distances on packed codes
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+def codes_path(features_file, kind):
+    """Codes are saved next to the features they were built from"""
+    return Path(features_file).with_name(f"features_{kind}.npz")
+
+
+class QuantizedCodes:
+    def __init__(self, kind, codes, scale=None, rescore_factor=10, block_size=DEFAULT_BLOCK_SIZE):
+        if kind not in QUANTIZATION_KINDS:
+            raise ValueError(f"Unknown quantization {kind!r}, expected one of {QUANTIZATION_KINDS}")
+        self.kind = kind
+        self.codes = codes
+        self.scale = scale
+        self.rescore_factor = rescore_factor
+        self.block_size = block_size
+
+    @classmethod
+    def build(cls, features, kind, block_size=DEFAULT_BLOCK_SIZE, **options):
+        total, dim = features.shape
+        scale = None
+        if kind == "int8":
+            # Per-dimension scale so the largest absolute value maps to 127
+            max_abs = np.zeros(dim, dtype=np.float32)
+            for start in range(0, total, block_size):
+                block = np.abs(np.asarray(features[start:start + block_size], dtype=np.float32))
+                max_abs = np.maximum(max_abs, block.max(axis=0))
+            scale = np.maximum(max_abs, 1e-12) / 127
+            codes = np.empty((total, dim), dtype=np.int8)
+        else:
+            codes = np.empty((total, (dim + 7) // 8), dtype=np.uint8)
+        for start in range(0, total, block_size):
+            block = np.asarray(features[start:start + block_size], dtype=np.float32)
+            if kind == "int8":
+                codes[start:start + len(block)] = np.clip(np.rint(block / scale), -127, 127)
+            else:
+                codes[start:start + len(block)] = np.packbits(block > 0, axis=1)
+        return cls(kind, codes, scale, block_size=block_size, **options)
+
+    def save(self, path):
+        if self.scale is None:
+            np.savez(path, kind=self.kind, codes=self.codes)
+        else:
+            np.savez(path, kind=self.kind, codes=self.codes, scale=self.scale)
+
+    @classmethod
+    def load(cls, path, **options):
+        data = np.load(path)
+        scale = data["scale"] if "scale" in data else None
+        return cls(str(data["kind"]), data["codes"], scale, **options)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes
+
+    def approximate_scores(self, block, text_features):
+        # (Q, block) first-pass scores, higher is better
+        if self.kind == "int8":
+            return (text_features * self.scale) @ block.astype(np.float32).T
+        query_codes = np.packbits(text_features > 0, axis=1)
+        # Negated Hamming distance between every query and every photo of the block
+        distances = np.stack([_POPCOUNT[block ^ code].sum(axis=1) for code in query_codes])
+        return -distances.astype(np.float32)
+
+    def shortlist(self, text_features, count):
+        """The count best photo indices of each query according to the codes alone"""
+        best = [(np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)) for _ in text_features]
+        for start in range(0, self.codes.shape[0], self.block_size):
+            block = self.codes[start:start + self.block_size]
+            block_scores = self.approximate_scores(block, text_features)
+            block_indices = np.arange(start, start + len(block), dtype=np.int64)
+            for q in range(len(text_features)):
+                best[q] = select_topk(
+                    np.concatenate([best[q][0], block_scores[q]]),
+                    np.concatenate([best[q][1], block_indices]),
+                    count,
+                )
+        return [indices for _, indices in best]
+
+    def search(self, photo_features, text_features, k, rescore_factor=None):
+        """Shortlist with the codes, then rescore exactly; same layout as blockwise_topk"""
+        rescore_factor = rescore_factor or self.rescore_factor
+        text_features = np.atleast_2d(np.asarray(text_features, dtype=np.float32))
+        k = min(k, self.codes.shape[0])
+        indices = np.empty((len(text_features), k), dtype=np.int64)
+        scores = np.empty((len(text_features), k), dtype=np.float32)
+        for q, candidates in enumerate(self.shortlist(text_features, k * rescore_factor)):
+            candidates = np.sort(candidates)
+            exact = np.asarray(photo_features[candidates], dtype=np.float32) @ text_features[q]
+            scores[q], indices[q] = select_topk(exact, candidates, k)
+        return indices, scores
+
+
+def build_codes(features_file, kind):
+    """Quantize a features.npy and save the codes next to it"""
+    features = np.load(features_file, mmap_mode="r")
+    codes = QuantizedCodes.build(features, kind)
+    output_file = codes_path(features_file, kind)
+    codes.save(output_file)
+    print(f"{kind} codes saved to {output_file} ({codes.nbytes / features.nbytes:.3f}x of features.npy)")
+    return output_file
+
+
+def evaluate_quantization(features_file, text_features, k=10, rescore_factors=(1, 2, 5, 10, 20)):
+    """recall@k against the exact scorer, latency and memory ratio for each kind and rescore factor"""
+    photo_features = np.load(features_file, mmap_mode="r")
+    text_features = np.atleast_2d(np.asarray(text_features, dtype=np.float32))
+    exact, _ = blockwise_topk(photo_features, text_features, k)
+    float32_bytes = photo_features.shape[0] * photo_features.shape[1] * 4
+    report = []
+    for kind in QUANTIZATION_KINDS:
+        if not codes_path(features_file, kind).exists():
+            build_codes(features_file, kind)
+        codes = QuantizedCodes.load(codes_path(features_file, kind))
+        for rescore_factor in rescore_factors:
+            start = time.perf_counter()
+            approx, _ = codes.search(photo_features, text_features, k, rescore_factor)
+            elapsed = time.perf_counter() - start
+            hits = sum(len(np.intersect1d(a, e)) for a, e in zip(approx, exact))
+            report.append({
+                "kind": kind,
+                "rescore_factor": rescore_factor,
+                f"recall@{k}": hits / exact.size,
+                "latency_ms": 1000 * elapsed / len(text_features),
+                "compression_vs_float32": float32_bytes / codes.nbytes,
+            })
+    return report
+
+
+if __name__ == "__main__":
+    # Measure the quality loss: python quantization.py data/lite/features/features.npy
+    import sys
+
+    features_file = sys.argv[1] if len(sys.argv) > 1 else "data/lite/features/features.npy"
+    photo_features = np.load(features_file, mmap_mode="r")
+    # Use a random sample of photo vectors as stand-in queries
+    rng = np.random.default_rng(0)
+    queries = np.asarray(photo_features[np.sort(rng.choice(len(photo_features), size=200, replace=False))])
+    for row in evaluate_quantization(features_file, queries):
+        print(row)
@@ -0,0 +1,97 @@
+# Cache of encoded search queries, so repeated queries skip clip.tokenize and model.encode_text.
+# Entries are keyed on (encoder name, normalized query text) and evicted least-recently-used first;
+# the encoder name includes the variant (text-only, int8, TorchScript) that produced the embedding.
+# With a cache_file the entries are loaded at startup and written back (atomically) on flush/exit.
+import atexit
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+
+def normalize_query(query):
+    # CLIP's tokenizer lower-cases and collapses whitespace, so these queries encode identically
+    return " ".join(query.lower().split())
+
+
+class EmbeddingCache:
+    def __init__(self, max_size=1024, cache_file=None, flush_every=100):
+        self.max_size = max_size
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.flush_every = flush_every
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._unsaved = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        if self.cache_file is not None:
+            self.load()
+            atexit.register(self.flush)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, model_name, query):
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return embedding
+
+    def put(self, model_name, query, embedding):
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            self._entries[key] = np.asarray(embedding, dtype=np.float32)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._unsaved += 1
+            flush = self.cache_file is not None and self._unsaved >= self.flush_every
+        if flush:
+            self.flush()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def load(self):
+        if not self.cache_file.exists():
+            return
+        data = np.load(self.cache_file)
+        # Saved oldest first, so the LRU order survives restarts
+        for model_name, query, embedding in zip(data["model_names"], data["queries"], data["embeddings"]):
+            self._entries[(str(model_name), str(query))] = embedding
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+        print(f"Query cache loaded: {len(self._entries)} entries from {self.cache_file}")
+
+    def flush(self):
+        if self.cache_file is None:
+            return
+        with self._flush_lock:
+            with self._lock:
+                if not self._entries:
+                    return
+                keys = list(self._entries)
+                embeddings = np.stack([self._entries[key] for key in keys])
+                self._unsaved = 0
+            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = self.cache_file.with_name(self.cache_file.stem + ".tmp.npz")
+            np.savez(tmp_file,
+                     model_names=np.array([key[0] for key in keys]),
+                     queries=np.array([key[1] for key in keys]),
+                     embeddings=embeddings)
+            os.replace(tmp_file, self.cache_file)
@@ -0,0 +1,106 @@
+# Micro-batching of concurrent searches.
+# Every UI event calling engine.search() on its own costs one single-row encode_text and one
+# matrix-vector scan of the features. The scheduler instead queues the queries of concurrent
+# callers, and a worker thread takes everything that arrives within max_wait seconds (up to
+# max_batch_size queries) and answers it with one engine.search_batch() call: one batched encode
+# and one matrix-matrix scoring pass. Queries arriving while a batch runs form the next batch, so
+# a lone user only ever waits max_wait extra.
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from metrics import count, current_trace, observe, trace
+
+DEFAULT_MAX_BATCH_SIZE = 32
+DEFAULT_MAX_WAIT = 0.002
+
+
+class QueryScheduler:
+    def __init__(self, engine, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name="query-scheduler", daemon=True)
+        self._worker.start()
+
+    def submit(self, query, k=5, filter=None):
+        """Future of the ranked photo IDs of query"""
+        future = Future()
+        # The caller's trace, if any, gets the stages of the batch that answers it
+        self._queue.put((query, k, filter, future, time.perf_counter(), current_trace()))
+        return future
+
+    def search(self, query, k=5, filter=None, timeout=None):
+        return self.submit(query, k, filter).result(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                # Answer what was collected, then stop
+                self._queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            dispatched = time.perf_counter()
+            # Queries with different filters score different rows, so each filter is its own pass
+            groups = {}
+            for request in batch:
+                groups.setdefault(request[2], []).append(request)
+            for group in groups.values():
+                self._answer(group, dispatched)
+
+    def _answer(self, batch, dispatched):
+        count("scheduler_batches")
+        count("scheduler_queries", len(batch))
+        try:
+            # One encode and one scoring pass at the largest k asked for, cut down per caller
+            with trace() as stages:
+                results = self.engine.search_batch([request[0] for request in batch],
+                                                   max(request[1] for request in batch),
+                                                   filter=batch[0][2])
+        except Exception as e:
+            for request in batch:
+                request[3].set_exception(e)
+            return
+        for (query, k, filter, future, submitted, caller_stages), result in zip(batch, results):
+            observe("queue_wait", dispatched - submitted)
+            if caller_stages is not None:
+                caller_stages["queue_wait"] = caller_stages.get("queue_wait", 0.0) + dispatched - submitted
+                for stage, seconds in stages.items():
+                    if stage != "total":
+                        caller_stages[stage] = caller_stages.get(stage, 0.0) + seconds
+            future.set_result(result[:k])
+
+
+# One scheduler per engine, shared by every UI event handler in the process
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(engine, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait=DEFAULT_MAX_WAIT):
+    with _schedulers_lock:
+        if id(engine) not in _schedulers:
+            _schedulers[id(engine)] = QueryScheduler(engine, max_batch_size, max_wait)
+        return _schedulers[id(engine)]
@@ -0,0 +1,91 @@
+# Compositing of search results into a single in-memory image, for the chat UIs.
+# Replaces a matplotlib figure per message (full-size imread + savefig to a PNG in the working
+# directory): the display thumbnails are pasted onto one PIL canvas, which Gradio takes directly.
+# Grids are cached by (data set, query, photo IDs), so the same answer is never rendered twice.
+import math
+import threading
+from collections import OrderedDict
+
+from metrics import count, span
+from thumbnails import get_thumbnail, thumbnail_settings, DISPLAY_SIZE
+
+ROWS = 2
+CAPTION_HEIGHT = 16
+TITLE_HEIGHT = 28
+PADDING = 8
+BACKGROUND = (255, 255, 255)
+MISSING = (235, 235, 235)
+TEXT = (40, 40, 40)
+
+_grid_cache = OrderedDict()
+_grid_cache_size = 256
+_grid_cache_lock = threading.Lock()
+
+
+def _draw_centered(draw, text, box, font):
+    left, top, right, bottom = box
+    text_left, text_top, text_right, text_bottom = draw.textbbox((0, 0), text, font=font)
+    x = left + (right - left - (text_right - text_left)) // 2
+    y = top + (bottom - top - (text_bottom - text_top)) // 2
+    draw.text((x, y), text, fill=TEXT, font=font)
+
+
+def compose_grid(image_paths, captions, title=None, rows=ROWS, cell_size=DISPLAY_SIZE):
+    """One RGB image with every picture in a cell_size box, captioned, under an optional title"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    columns = max(1, math.ceil(len(image_paths) / rows))
+    rows = max(1, math.ceil(len(image_paths) / columns))
+    cell_width = cell_size + PADDING
+    cell_height = cell_size + CAPTION_HEIGHT + PADDING
+    top = TITLE_HEIGHT if title else 0
+    canvas = Image.new("RGB", (columns * cell_width + PADDING, top + rows * cell_height + PADDING), BACKGROUND)
+    draw = ImageDraw.Draw(canvas)
+    font = ImageFont.load_default()
+    if title:
+        _draw_centered(draw, title, (0, 0, canvas.width, TITLE_HEIGHT), font)
+
+    for i, (image_path, caption) in enumerate(zip(image_paths, captions)):
+        left = PADDING + (i % columns) * cell_width
+        cell_top = top + PADDING + (i // columns) * cell_height
+        try:
+            with Image.open(image_path) as img:
+                img.draft("RGB", (cell_size, cell_size))
+                img = img.convert("RGB")
+                img.thumbnail((cell_size, cell_size))
+                # Centered in its cell
+                canvas.paste(img, (left + (cell_size - img.width) // 2, cell_top + (cell_size - img.height) // 2))
+        except OSError:
+            draw.rectangle((left, cell_top, left + cell_size, cell_top + cell_size), fill=MISSING)
+            _draw_centered(draw, "Image not found", (left, cell_top, left + cell_size, cell_top + cell_size), font)
+        _draw_centered(draw, caption, (left, cell_top + cell_size, left + cell_size,
+                                       cell_top + cell_size + CAPTION_HEIGHT), font)
+    return canvas
+
+
+def render_results(file_path, version, photo_ids, query):
+    """PIL image of the photos in photo_ids under a title for query; cached, do not modify it"""
+    display_size = thumbnail_settings(file_path, version)["display_size"]
+    key = (str(file_path), version, query, tuple(photo_ids), display_size)
+    with _grid_cache_lock:
+        if key in _grid_cache:
+            _grid_cache.move_to_end(key)
+            count("render_cache_lookups", result="hit")
+            return _grid_cache[key]
+    count("render_cache_lookups", result="miss")
+
+    with span("render"):
+        image_paths = [get_thumbnail(file_path, version, photo_id) for photo_id in photo_ids]
+        grid = compose_grid(image_paths, [f"Photo ID: {photo_id}" for photo_id in photo_ids],
+                            f'Images found for: "{query}"', cell_size=display_size)
+    with _grid_cache_lock:
+        _grid_cache[key] = grid
+        while len(_grid_cache) > _grid_cache_size:
+            _grid_cache.popitem(last=False)
+    return grid
+
+
+def gallery_items(file_path, version, photo_ids):
+    """(thumbnail path, caption) pairs for a gr.Gallery, which loads the files itself"""
+    with span("render"):
+        return [(get_thumbnail(file_path, version, photo_id), photo_id) for photo_id in photo_ids]
@@ -0,0 +1,227 @@
+# Scatter-gather exact search over a feature matrix split into row-range shards.
+# Each shard is served by its own process, which memory-maps features.npy and scores only its rows,
+# so BLAS runs on every core and no process needs the whole matrix resident. Workers talk over
+# multiprocessing.connection sockets, so a shard can also run on another host:
+#     SHARD_AUTHKEY=<secret> python sharded_search.py data/full/features/features.npy 0 500000 0.0.0.0 6000
+# The connections unpickle what they receive, so the key must be a secret shared only with the
+# coordinator: a worker does not start without one.
+# The coordinator sends each query batch to one healthy replica of every shard, retries on another
+# replica when one fails, and merges the local top-k lists into the global top-k.
+import os
+import sys
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+
+from metrics import count
+from topk_scorer import blockwise_topk, select_topk, DEFAULT_BLOCK_SIZE
+
+DEFAULT_TIMEOUT = 30.0
+
+
+def shard_ranges(total, shards_count):
+    """[start, stop) row ranges of shards_count nearly equal shards"""
+    bounds = np.linspace(0, total, shards_count + 1).astype(np.int64)
+    return [(int(bounds[i]), int(bounds[i + 1])) for i in range(shards_count)]
+
+
+def serve_shard(features_file, start, stop, address, authkey, block_size=DEFAULT_BLOCK_SIZE, ready=None):
+    """Worker loop: answer ("topk", text_features, k) with global (indices, scores) of rows [start, stop).
+
+    A request that fails is answered with ("error", message) and the worker keeps serving.
+    """
+    features = np.load(features_file, mmap_mode="r")[start:stop]
+    with Listener(address, authkey=authkey) as listener:
+        if ready is not None:
+            # Report the bound address (the port may have been chosen by the OS)
+            ready.put(listener.address)
+        while True:
+            with listener.accept() as conn:
+                while True:
+                    try:
+                        message = conn.recv()
+                    except (EOFError, OSError):
+                        break
+                    try:
+                        if message[0] == "ping":
+                            conn.send(("pong", start, stop))
+                        elif message[0] == "topk":
+                            _, text_features, k = message
+                            indices, scores = blockwise_topk(features, text_features, k, block_size)
+                            conn.send(("ok", indices + start, scores))
+                        elif message[0] == "shutdown":
+                            conn.send(("ok",))
+                            return
+                        else:
+                            conn.send(("error", f"unknown request {message[0]!r}"))
+                    except (EOFError, OSError):
+                        break
+                    except Exception as e:
+                        # A bad request must not take the shard down
+                        conn.send(("error", repr(e)))
+
+
+class ShardReplica:
+    def __init__(self, shard, address, authkey, timeout=DEFAULT_TIMEOUT, process=None):
+        self.shard = shard
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self.process = process
+        self.healthy = True
+        self.failures = 0
+        self._conn = None
+        # One request at a time per connection
+        self._lock = threading.Lock()
+
+    def request(self, message):
+        with self._lock:
+            try:
+                if self._conn is None:
+                    self._conn = Client(self.address, authkey=self.authkey)
+                self._conn.send(message)
+                if not self._conn.poll(self.timeout):
+                    raise TimeoutError(f"shard {self.shard} at {self.address} did not answer in {self.timeout}s")
+                reply = self._conn.recv()
+            except Exception:
+                self._drop_connection()
+                raise
+        if reply[0] == "error":
+            # The worker and its connection are fine, only this request failed
+            raise RuntimeError(f"shard {self.shard} at {self.address} failed the request: {reply[1]}")
+        return reply
+
+    def _drop_connection(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except OSError:
+                pass
+            self._conn = None
+
+
+class ShardedSearcher:
+    def __init__(self, features_file, shards_count=None, replication=1, addresses=None,
+                 authkey=None, timeout=DEFAULT_TIMEOUT, block_size=DEFAULT_BLOCK_SIZE, allow_partial=True):
+        """Start shards_count * replication local workers, or connect to remote ones.
+
+        addresses, when given, is a list with one list of replica addresses per shard, and
+        authkey (default: the SHARD_AUTHKEY environment variable) must match the key the remote
+        workers were started with. With allow_partial=False a search raises instead of answering
+        from the shards that are up.
+        """
+        self.features_file = str(features_file)
+        self.allow_partial = allow_partial
+        if addresses is not None:
+            authkey = authkey or os.environ.get("SHARD_AUTHKEY", "").encode() or None
+            if authkey is None:
+                raise ValueError("Remote shards need the authkey they were started with (authkey or SHARD_AUTHKEY)")
+        elif authkey is None:
+            # Local workers only ever talk to this process
+            authkey = os.urandom(16)
+        self.authkey = authkey.encode() if isinstance(authkey, str) else authkey
+        self.replicas = []
+        if addresses is None:
+            total = np.load(self.features_file, mmap_mode="r").shape[0]
+            shards_count = shards_count or os.cpu_count() or 1
+            context = multiprocessing.get_context("spawn")
+            ready = context.Queue()
+            for shard, (start, stop) in enumerate(shard_ranges(total, shards_count)):
+                shard_replicas = []
+                for _ in range(replication):
+                    process = context.Process(
+                        target=serve_shard,
+                        args=(self.features_file, start, stop, ("127.0.0.1", 0), self.authkey, block_size, ready),
+                        daemon=True,
+                    )
+                    process.start()
+                    address = ready.get(timeout=timeout)
+                    shard_replicas.append(ShardReplica(shard, address, self.authkey, timeout, process))
+                self.replicas.append(shard_replicas)
+            print(f"Sharded search: {shards_count} shards x {replication} replicas over {total} photos")
+        else:
+            for shard, shard_addresses in enumerate(addresses):
+                self.replicas.append([ShardReplica(shard, tuple(address), self.authkey, timeout)
+                                      for address in shard_addresses])
+        self._pool = ThreadPoolExecutor(max_workers=len(self.replicas), thread_name_prefix="shard")
+
+    def _query_shard(self, shard_replicas, text_features, k):
+        # Healthy replicas first; an unhealthy one is still tried as a last resort
+        for replica in sorted(shard_replicas, key=lambda r: not r.healthy):
+            try:
+                _, indices, scores = replica.request(("topk", text_features, k))
+                replica.healthy = True
+                return indices, scores
+            except Exception as e:
+                replica.healthy = False
+                replica.failures += 1
+                print(f"Shard {replica.shard} replica {replica.address} failed: {e!r}")
+        return None
+
+    def search(self, text_features, k):
+        """Global exact top-k; same (indices, scores) layout as topk_scorer.blockwise_topk"""
+        text_features = np.atleast_2d(np.asarray(text_features, dtype=np.float32))
+        futures = [self._pool.submit(self._query_shard, shard_replicas, text_features, k)
+                   for shard_replicas in self.replicas]
+        results = [f.result() for f in futures]
+        missing = [shard for shard, result in enumerate(results) if result is None]
+        if missing:
+            # A top-k without some shards is wrong, so it is counted (sharded_partial_results in /metrics)
+            count("sharded_partial_results")
+            count("sharded_missing_shards", len(missing))
+            if not self.allow_partial:
+                raise RuntimeError(f"Shards {missing} unavailable")
+            print(f"Shards {missing} unavailable, results are partial")
+        results = [result for result in results if result is not None]
+        if not results:
+            raise RuntimeError("No shard could answer the query")
+
+        all_indices, all_scores = [], []
+        for q in range(len(text_features)):
+            scores, indices = select_topk(
+                np.concatenate([scores[q] for _, scores in results]),
+                np.concatenate([indices[q] for indices, _ in results]),
+                k,
+            )
+            all_indices.append(indices)
+            all_scores.append(scores)
+        return np.stack(all_indices), np.stack(all_scores)
+
+    def check_health(self):
+        """Ping every replica; returns {shard: [healthy flags]} and marks replicas accordingly"""
+        status = {}
+        for shard_replicas in self.replicas:
+            for replica in shard_replicas:
+                try:
+                    replica.healthy = replica.request(("ping",))[0] == "pong"
+                except Exception:
+                    replica.healthy = False
+                status.setdefault(replica.shard, []).append(replica.healthy)
+        return status
+
+    def close(self):
+        for shard_replicas in self.replicas:
+            for replica in shard_replicas:
+                if replica.process is not None:
+                    try:
+                        replica.request(("shutdown",))
+                    except Exception:
+                        pass
+                    replica.process.join(timeout=5)
+                    if replica.process.is_alive():
+                        replica.process.terminate()
+                replica._drop_connection()
+        self._pool.shutdown(wait=False)
+
+
+if __name__ == "__main__":
+    # Serve one shard for a remote coordinator; the key is read from SHARD_AUTHKEY
+    features_file, start, stop, host, port = sys.argv[1:6]
+    if not os.environ.get("SHARD_AUTHKEY"):
+        sys.exit("SHARD_AUTHKEY is not set: refusing to serve without a secret key shared with the coordinator")
+    authkey = os.environ["SHARD_AUTHKEY"].encode()
+    print(f"Serving rows [{start}, {stop}) of {features_file} on {host}:{port}")
+    serve_shard(features_file, int(start), int(stop), (host, int(port)), authkey)
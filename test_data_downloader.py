@@ -0,0 +1,138 @@
+# Tests of download_data against a local HTTP server: flaky (503 then 200), missing (404),
+# redirected and unusable URLs, reruns from the manifest, and errors outside the HTTP request.
+#     python -m pytest test_data_downloader.py   (or python -m unittest test_data_downloader)
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pandas as pd
+
+from data_downloader import download_data
+
+FLAKY_FAILURES = 2
+
+
+class PhotoHandler(BaseHTTPRequestHandler):
+    # /ok/<id>, /flaky/<id> (503 twice, then 200), /redirect/<id> (302 to /ok/<id>), anything else 404
+    protocol_version = "HTTP/1.1"
+    requests = Counter()
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        PhotoHandler.requests[path] += 1
+        kind, _, photo_id = path.strip("/").partition("/")
+        if kind == "ok" or (kind == "flaky" and PhotoHandler.requests[path] > FLAKY_FAILURES):
+            self._reply(200, f"jpeg of {photo_id}".encode())
+        elif kind == "flaky":
+            self._reply(503, b"busy")
+        elif kind == "redirect":
+            self._reply(302, b"", {"Location": f"/ok/{photo_id}"})
+        else:
+            self._reply(404, b"not found")
+
+    def _reply(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloadDataTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), PhotoHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        PhotoHandler.requests.clear()
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data_path = Path(self.tmp_dir.name)
+        (self.data_path / "lite").mkdir()
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def write_photos(self, urls):
+        pd.DataFrame({"photo_id": list(urls), "photo_description": "", "photo_image_url": list(urls.values())}) \
+            .to_csv(self.data_path / "lite" / "photos.tsv000", sep="\t", index=False)
+
+    def download(self, **options):
+        download_data("lite", self.data_path, threads_count=4, backoff=0, timeout=5, **options)
+        manifest = pd.read_csv(self.data_path / "lite" / "download_manifest.csv", dtype={"photo_id": str},
+                               keep_default_na=False)
+        # Later lines win, like DownloadManifest
+        return manifest.drop_duplicates("photo_id", keep="last").set_index("photo_id")
+
+    def photo(self, photo_id):
+        return self.data_path / "lite" / "photos" / f"{photo_id}.jpg"
+
+    def test_flaky_missing_and_redirected_photos(self):
+        self.write_photos({
+            "good": f"{self.base_url}/ok/good",
+            "flaky": f"{self.base_url}/flaky/flaky",
+            "missing": f"{self.base_url}/missing/missing",
+            "moved": f"{self.base_url}/redirect/moved",
+        })
+        manifest = self.download()
+
+        self.assertEqual(self.photo("good").read_bytes(), b"jpeg of good")
+        # 503 is retried with backoff until it succeeds
+        self.assertEqual(self.photo("flaky").read_bytes(), b"jpeg of flaky")
+        self.assertEqual(manifest.loc["flaky", "attempts"], FLAKY_FAILURES + 1)
+        # 404 is not retried
+        self.assertFalse(self.photo("missing").exists())
+        self.assertEqual(manifest.loc["missing", "status"], "failed")
+        self.assertEqual(manifest.loc["missing", "error"], "HTTP 404")
+        self.assertEqual(PhotoHandler.requests["/missing/missing"], 1)
+        # Redirects are followed
+        self.assertEqual(self.photo("moved").read_bytes(), b"jpeg of moved")
+        self.assertEqual(manifest.loc["moved", "status"], "completed")
+        self.assertEqual(list(Path(self.data_path / "lite" / "photos").glob("*.part")), [])
+
+    def test_rerun_skips_completed_and_optionally_failed_photos(self):
+        self.write_photos({"good": f"{self.base_url}/ok/good", "missing": f"{self.base_url}/missing/missing"})
+        self.download()
+        self.download(retry_failed=False)
+        self.assertEqual(PhotoHandler.requests["/ok/good"], 1)
+        self.assertEqual(PhotoHandler.requests["/missing/missing"], 1)
+        self.download()
+        self.assertEqual(PhotoHandler.requests["/ok/good"], 1)
+        self.assertEqual(PhotoHandler.requests["/missing/missing"], 2)
+
+    def test_unexpected_errors_fail_only_their_photo(self):
+        self.write_photos({
+            "good": f"{self.base_url}/ok/good",
+            "no_url": None,
+            "unwritable": f"{self.base_url}/ok/unwritable",
+            "rejected": f"{self.base_url}/ok/rejected",
+        })
+        # A directory in the way of the .part file makes the write fail with an OSError
+        (self.data_path / "lite" / "photos").mkdir()
+        (self.data_path / "lite" / "photos" / "unwritable.jpg.part").mkdir()
+
+        def on_photo(photo_id, photo_path):
+            if photo_id == "rejected":
+                raise RuntimeError("consumer failed")
+
+        manifest = self.download(on_photo=on_photo)
+        self.assertEqual(manifest.loc["good", "status"], "completed")
+        for photo_id, error in (("no_url", "TypeError"), ("unwritable", "IsADirectoryError"),
+                                ("rejected", "RuntimeError")):
+            self.assertEqual(manifest.loc[photo_id, "status"], "failed")
+            self.assertTrue(manifest.loc[photo_id, "error"].startswith(error), manifest.loc[photo_id, "error"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+# Tests of SearchEngine.more_like_this with collapse_duplicates=True: the precomputed graph and the
+# scan must both leave out the photo's own near-duplicates and show one photo per cluster.
+#     python -m pytest test_more_like_this.py   (or python -m unittest test_more_like_this)
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from dedup import find_duplicates
+from model_image_search import SearchEngine
+from neighbor_graph import build_knn_graph, graph_paths
+
+PHOTOS = 1000
+DIM = 64
+
+
+class MoreLikeThisTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        rng = np.random.default_rng(0)
+        features = rng.standard_normal((PHOTOS, DIM)).astype(np.float32)
+        # p10 and p11 are copies of p5, p20 is a copy of p6
+        features[[10, 11]] = features[5]
+        features[20] = features[6]
+        features /= np.linalg.norm(features, axis=1, keepdims=True)
+        self.features_file = self.tmp_dir / "features.npy"
+        self.photo_ids_file = self.tmp_dir / "photo_ids.csv"
+        np.save(self.features_file, features.astype(np.float16))
+        pd.DataFrame({"photo_id": [f"p{i}" for i in range(PHOTOS)]}).to_csv(self.photo_ids_file, index=False)
+        find_duplicates(self.features_file, self.photo_ids_file, threshold=0.99)
+
+    def engine(self):
+        return SearchEngine(self.photo_ids_file, self.features_file, collapse_duplicates=True)
+
+    def test_graph_and_scan_collapse_the_same_way(self):
+        scanned = self.engine().more_like_this("p5", 4)
+        self.assertEqual(len(scanned), 4)
+        self.assertNotIn("p10", scanned)
+        self.assertNotIn("p11", scanned)
+
+        build_knn_graph(self.features_file, k=8)
+        engine = self.engine()
+        self.assertIsNotNone(engine.neighbor_graph)
+        self.assertEqual(engine.more_like_this("p5", 4), scanned)
+        self.assertEqual(engine.more_like_this("p10", 4), self.scanned("p10", 4))
+        # More neighbours than the graph holds: the scan gives the same collapsed ranking
+        self.assertEqual(engine.more_like_this("p5", 40)[:4], scanned)
+
+    def test_graph_with_too_many_duplicates_falls_back_to_the_scan(self):
+        # With k=2 the graph of p5 holds only its two copies, nothing is left once they are dropped
+        build_knn_graph(self.features_file, k=2)
+        engine = self.engine()
+        self.assertEqual(engine.more_like_this("p5", 2), self.scanned("p5", 2))
+        self.assertNotIn("p10", engine.more_like_this("p5", 2))
+
+    def scanned(self, photo_id, k):
+        # more_like_this of an engine without the graph, which is loaded on first use
+        for path in graph_paths(self.features_file):
+            path.rename(path.with_name(path.name + ".bak"))
+        try:
+            return self.engine().more_like_this(photo_id, k)
+        finally:
+            for path in graph_paths(self.features_file):
+                shutil.move(path.with_name(path.name + ".bak"), path)
+
+
+if __name__ == "__main__":
+    unittest.main()
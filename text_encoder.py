@@ -0,0 +1,194 @@
+# Query-serving text encoder: only CLIP's text tower, optionally int8 and/or TorchScript, on CPU.
+# Query time never needs the image tower, so it is dropped right after loading, and the text
+# transformer's Linear layers can be dynamically quantized to int8. Compare the variants with
+#     python text_encoder.py compare [features.npy]
+# which reports load time, encode latency and RSS of each variant (each in a fresh process) and
+# how closely its embeddings and top-k rankings agree with the full fp32 model.
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+VARIANTS = ("full-fp32", "text-fp32", "text-int8", "text-int8-jit")
+SAMPLE_QUERIES = [
+    "two birds flying above water",
+    "sunset over mountains",
+    "people walking in the city",
+    "flowers in a garden",
+    "a dog playing in the snow",
+    "a cup of coffee on a wooden table",
+    "aerial view of a beach",
+    "a red car parked on the street",
+    "portrait of a smiling woman",
+    "city skyline at night",
+]
+
+
+def _text_encoder_class():
+    import torch
+
+    class TextEncoder(torch.nn.Module):
+        """CLIP's encode_text as a standalone module, without the image tower"""
+
+        def __init__(self, clip_model):
+            super().__init__()
+            self.token_embedding = clip_model.token_embedding
+            self.positional_embedding = clip_model.positional_embedding
+            self.transformer = clip_model.transformer
+            self.ln_final = clip_model.ln_final
+            self.text_projection = clip_model.text_projection
+
+        def forward(self, text):
+            x = self.token_embedding(text) + self.positional_embedding
+            x = x.permute(1, 0, 2)  # NLD -> LND
+            x = self.transformer(x)
+            x = x.permute(1, 0, 2)  # LND -> NLD
+            x = self.ln_final(x)
+            # Features of the end-of-text token (the highest token id in each sequence)
+            return x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
+
+        def encode_text(self, text):
+            return self(text)
+
+    return TextEncoder
+
+
+def _frozen_encoder_class():
+    import torch
+
+    class FrozenTextEncoder(torch.nn.Module):
+        """encode_text() over a traced and frozen TextEncoder: the TorchScript module only keeps forward"""
+
+        def __init__(self, scripted):
+            super().__init__()
+            self.scripted = scripted
+
+        def forward(self, text):
+            return self.scripted(text)
+
+        def encode_text(self, text):
+            return self.scripted(text)
+
+    return FrozenTextEncoder
+
+
+def load_text_encoder(model_name="ViT-B/32", quantize=True, torchscript=False, threads=None):
+    """CPU text-only encoder with an encode_text(tokens) method, like the full CLIP model"""
+    import clip
+    import torch
+
+    if threads:
+        # Intra-op parallelism of a single query; several serving processes should split the cores
+        torch.set_num_threads(threads)
+    model, _ = clip.load(model_name, device="cpu", jit=False)
+    encoder = _text_encoder_class()(model.float()).eval()
+    # Only the text tower is referenced from here on, the image tower is freed
+    del model
+    gc.collect()
+    if quantize:
+        encoder = torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+    if torchscript:
+        with torch.no_grad():
+            scripted = torch.jit.freeze(torch.jit.trace(encoder, clip.tokenize(SAMPLE_QUERIES[:2])).eval())
+        encoder = _frozen_encoder_class()(scripted)
+    return encoder
+
+
+def _rss_mb():
+    # Current resident set size, from /proc on Linux
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return float("nan")
+
+
+def _run_variant(variant, output_file, threads=None, repeats=20):
+    # Runs in a fresh process: load, warm up, time single-query encodes, save the embeddings
+    import clip
+    import torch
+
+    start = time.perf_counter()
+    if variant == "full-fp32":
+        if threads:
+            torch.set_num_threads(threads)
+        encoder, _ = clip.load("ViT-B/32", device="cpu", jit=False)
+    else:
+        encoder = load_text_encoder(quantize="int8" in variant, torchscript=variant.endswith("jit"), threads=threads)
+    load_s = time.perf_counter() - start
+
+    latencies = []
+    embeddings = []
+    with torch.no_grad():
+        encoder.encode_text(clip.tokenize(SAMPLE_QUERIES[:1]))
+        for i in range(repeats):
+            query = SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]
+            start = time.perf_counter()
+            embedding = encoder.encode_text(clip.tokenize([query]))
+            latencies.append(time.perf_counter() - start)
+            if i < len(SAMPLE_QUERIES):
+                embeddings.append(embedding.float().numpy()[0])
+    embeddings = np.stack(embeddings)
+    np.save(output_file, embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True))
+    latencies.sort()
+    print(json.dumps({
+        "variant": variant,
+        "load_s": load_s,
+        "encode_p50_ms": 1000 * latencies[len(latencies) // 2],
+        "encode_p99_ms": 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "rss_mb": _rss_mb(),
+        "threads": torch.get_num_threads(),
+    }))
+
+
+def compare_variants(photo_features_file=None, k=10, threads=None):
+    """Latency/RSS of every variant, and its agreement with the full fp32 model"""
+    from topk_scorer import blockwise_topk
+
+    reports = []
+    embeddings = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for variant in VARIANTS:
+            output_file = os.path.join(tmp_dir, f"{variant}.npy")
+            command = [sys.executable, os.path.abspath(__file__), "run", variant, output_file]
+            if threads:
+                command.append(str(threads))
+            output = subprocess.run(command, capture_output=True, text=True)
+            if output.returncode != 0:
+                # A variant that cannot load or run is reported, the others are still compared
+                error = (output.stderr.strip().splitlines() or [f"exit code {output.returncode}"])[-1]
+                reports.append({"variant": variant, "error": error})
+                continue
+            reports.append(json.loads(output.stdout.strip().splitlines()[-1]))
+            embeddings[variant] = np.load(output_file)
+
+    if "full-fp32" not in embeddings:
+        return reports
+    reference = embeddings["full-fp32"]
+    photo_features = np.load(photo_features_file, mmap_mode="r") if photo_features_file else None
+    if photo_features is not None:
+        reference_topk, _ = blockwise_topk(photo_features, reference, k)
+    for report in reports:
+        if report["variant"] not in embeddings:
+            continue
+        variant_embeddings = embeddings[report["variant"]]
+        report["min_cosine_vs_fp32"] = float((variant_embeddings * reference).sum(axis=1).min())
+        if photo_features is not None:
+            variant_topk, _ = blockwise_topk(photo_features, variant_embeddings, k)
+            overlap = [len(np.intersect1d(a, b)) / k for a, b in zip(variant_topk, reference_topk)]
+            report[f"top{k}_overlap_vs_fp32"] = float(np.mean(overlap))
+    return reports
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "run":
+        _run_variant(sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else None)
+    else:
+        features_file = sys.argv[2] if len(sys.argv) > 2 else None
+        for row in compare_variants(features_file):
+            print(row)
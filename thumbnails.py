@@ -0,0 +1,119 @@
+# On-disk cache of downscaled JPEG derivatives of the photos.
+# The rerank payload and the UIs use these instead of decoding the 640px originals every time.
+# Thumbnails live in data/<version>/thumbnails/<size>/<photo_id>.jpg and are generated during
+# ingest; a missing thumbnail, or one older than its source photo, is regenerated on first use.
+# The display size, rerank size and JPEG quality chosen at ingest are saved in
+# data/<version>/thumbnails/settings.json, which every reader of thumbnails uses, so the UIs and the
+# reranker read the files that were generated instead of building their own on the request path.
+import json
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+from pathlib import Path
+
+# Longest edge in pixels of each derivative
+DISPLAY_SIZE = 320
+RERANK_SIZE = 384
+DEFAULT_SIZES = (DISPLAY_SIZE, RERANK_SIZE)
+DEFAULT_QUALITY = 85
+DEFAULT_SETTINGS = {"display_size": DISPLAY_SIZE, "rerank_size": RERANK_SIZE, "quality": DEFAULT_QUALITY}
+
+# Settings files already read, keyed by path and modification time
+_settings_cache = {}
+_settings_lock = threading.Lock()
+
+
+def photo_path(file_path, version, photo_id):
+    return Path(file_path) / version / "photos" / f"{photo_id}.jpg"
+
+
+def thumbnail_path(file_path, version, photo_id, size=DISPLAY_SIZE):
+    return Path(file_path) / version / "thumbnails" / str(size) / f"{photo_id}.jpg"
+
+
+def settings_path(file_path, version):
+    return Path(file_path) / version / "thumbnails" / "settings.json"
+
+
+def save_thumbnail_settings(file_path, version, sizes, quality=DEFAULT_QUALITY):
+    """Record the sizes (display size first, rerank size last) and quality the thumbnails are made with"""
+    path = settings_path(file_path, version)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    settings = {"display_size": int(sizes[0]), "rerank_size": int(sizes[-1]), "quality": int(quality)}
+    tmp_file = path.with_name(f"settings.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_file.write_text(json.dumps(settings))
+    os.replace(tmp_file, path)
+
+
+def thumbnail_settings(file_path, version):
+    """{"display_size", "rerank_size", "quality"} saved at ingest, the defaults when there is none"""
+    path = settings_path(file_path, version)
+    try:
+        key = (str(path), path.stat().st_mtime_ns)
+    except OSError:
+        return dict(DEFAULT_SETTINGS)
+    with _settings_lock:
+        if key not in _settings_cache:
+            _settings_cache[key] = {**DEFAULT_SETTINGS, **json.loads(path.read_text())}
+        return dict(_settings_cache[key])
+
+
+def _is_fresh(source, thumbnail):
+    return thumbnail.exists() and thumbnail.stat().st_mtime >= source.stat().st_mtime
+
+
+def make_thumbnail(source, thumbnail, size, quality=DEFAULT_QUALITY):
+    from PIL import Image
+    with Image.open(source) as img:
+        # draft() lets the JPEG decoder skip most of the pixels for large reductions
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+        img.thumbnail((size, size))
+        thumbnail.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename, so concurrent readers never see a half-written file; the name is unique
+        # per thread, as UI handlers and the ingest pool may make the same thumbnail at once
+        tmp_file = thumbnail.with_name(f"{thumbnail.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+        img.save(tmp_file, format="JPEG", quality=quality, optimize=True)
+    os.replace(tmp_file, thumbnail)
+
+
+def get_thumbnail(file_path, version, photo_id, size=None, quality=None):
+    """Path of an up-to-date thumbnail, or of the original photo if it cannot be made.
+
+    size and quality default to the display size and quality of the data set's thumbnail settings.
+    """
+    if size is None or quality is None:
+        settings = thumbnail_settings(file_path, version)
+        size = settings["display_size"] if size is None else size
+        quality = settings["quality"] if quality is None else quality
+    source = photo_path(file_path, version, photo_id)
+    thumbnail = thumbnail_path(file_path, version, photo_id, size)
+    if not source.exists():
+        return str(source)
+    if not _is_fresh(source, thumbnail):
+        try:
+            make_thumbnail(source, thumbnail, size, quality)
+        except Exception as e:
+            print(f"Cannot create thumbnail for {photo_id}: {e}")
+            return str(source)
+    return str(thumbnail)
+
+
+def generate_thumbnails(file_path, version, photo_ids=None, sizes=DEFAULT_SIZES, quality=DEFAULT_QUALITY,
+                        threads_count=8):
+    """Create the missing or stale thumbnails of every photo (or of photo_ids) at every size.
+
+    sizes are (display size, rerank size); they and quality are saved as the data set's settings.
+    """
+    save_thumbnail_settings(file_path, version, sizes, quality)
+    if photo_ids is None:
+        photo_ids = [photo.stem for photo in (Path(file_path) / version / "photos").glob("*.jpg")]
+
+    def generate(photo_id):
+        for size in sizes:
+            get_thumbnail(file_path, version, photo_id, size, quality)
+
+    pool = ThreadPool(threads_count)
+    pool.map(generate, photo_ids)
+    pool.close()
+    print(f"Thumbnails ready for {len(photo_ids)} photos at sizes {list(sizes)}")
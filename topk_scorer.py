@@ -0,0 +1,70 @@
+# Exact top-k scoring of the photo feature matrix, one fixed-size block at a time.
+# Only a block of similarities and the running top-k are ever held in memory, so the
+# cost is O(N) time and O(block_size + k) memory no matter how large the corpus is.
+import time
+
+import numpy as np
+
+from metrics import observe
+
+# Rows of the feature matrix scored per step (16384 x 512 float32 is a 32MB working block)
+DEFAULT_BLOCK_SIZE = 16384
+
+
+def select_topk(scores, indices, k):
+    """Keep the k best (score, index) pairs, highest score first and lowest index on ties"""
+    if k <= 0:
+        return scores[:0], indices[:0]
+    if len(scores) > k:
+        # kth largest score; everything above it is kept, ties on it go to the lowest indices
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        above = np.flatnonzero(scores > kth)
+        ties = np.flatnonzero(scores == kth)
+        ties = ties[np.argsort(indices[ties], kind="stable")[:k - len(above)]]
+        keep = np.concatenate([above, ties])
+        scores, indices = scores[keep], indices[keep]
+    # Sort by descending score, then ascending index, like a stable argsort of -similarities
+    order = np.lexsort((indices, -scores))
+    return scores[order], indices[order]
+
+
+def blockwise_topk(photo_features, text_features, k, block_size=DEFAULT_BLOCK_SIZE, rows=None):
+    """Return (indices, scores) of the k most similar photos for every query row.
+
+    photo_features is (N, D), text_features is (Q, D); both results are (Q, min(k, N)).
+    With rows (sorted photo indices, e.g. the photos matching a filter) only those are scored.
+    """
+    text_features = np.atleast_2d(np.asarray(text_features, dtype=np.float32))
+    queries_count = text_features.shape[0]
+    total = photo_features.shape[0] if rows is None else len(rows)
+    k = min(k, total)
+
+    best_scores = [np.empty(0, dtype=np.float32) for _ in range(queries_count)]
+    best_indices = [np.empty(0, dtype=np.int64) for _ in range(queries_count)]
+    # Time spent scoring and selecting, reported as the "score" and "topk" stages
+    score_seconds = select_seconds = 0.0
+    for start in range(0, total, block_size):
+        started = time.perf_counter()
+        if rows is None:
+            block_indices = np.arange(start, min(start + block_size, total), dtype=np.int64)
+            block = np.asarray(photo_features[start:start + block_size], dtype=np.float32)
+        else:
+            block_indices = np.asarray(rows[start:start + block_size], dtype=np.int64)
+            block = np.asarray(photo_features[block_indices], dtype=np.float32)
+        # (Q, block) similarities for this block only
+        block_scores = text_features @ block.T
+        scored = time.perf_counter()
+        for q in range(queries_count):
+            best_scores[q], best_indices[q] = select_topk(
+                np.concatenate([best_scores[q], block_scores[q]]),
+                np.concatenate([best_indices[q], block_indices]),
+                k,
+            )
+        score_seconds += scored - started
+        select_seconds += time.perf_counter() - scored
+    observe("score", score_seconds)
+    observe("topk", select_seconds)
+
+    indices = np.stack(best_indices) if queries_count else np.empty((0, k), dtype=np.int64)
+    scores = np.stack(best_scores) if queries_count else np.empty((0, k), dtype=np.float32)
+    return indices, scores
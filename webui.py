@@ -1,11 +1,18 @@
-from model_image_search import image_search
+from model_image_search import get_search_engine
+from query_scheduler import get_scheduler
 from gemini_ranker import gemini_rank
-from data_downloader import download_data
-from data_processor import process_data
+from ingest_pipeline import pipelined_ingest
+from result_renderer import gallery_items
 
 import gradio as gr
 from pathlib import Path
-from PIL import Image
+
+# Micro-batching of concurrent searches: queries arriving within SCHEDULER_MAX_WAIT seconds of
+# each other share one batch, up to SCHEDULER_MAX_BATCH_SIZE queries
+SCHEDULER_MAX_BATCH_SIZE = 32
+SCHEDULER_MAX_WAIT = 0.002
+# Event handlers allowed to run at once; Gradio runs one at a time by default
+CONCURRENCY_LIMIT = 16
 
 # Store state: search results and mode
 search_results = gr.State([])
@@ -15,6 +22,10 @@ search_mode = gr.State("lite")
 with gr.Blocks() as demo:
     gr.Markdown("## 🔍 AI Image Search Assistant")
     query_input = gr.Textbox(label="What picture do you want to search?")
+    search_type = gr.Radio(["CLIP", "Hybrid", "Keywords"], value="CLIP", label="Search type",
+                           info='Hybrid fuses CLIP with keyword matches on the descriptions; "quoted" words are required')
+    filter_input = gr.Textbox(label="Filter (optional)",
+                              placeholder="e.g. orientation == landscape and width >= 3000 and country in (Iceland, Norway)")
 
     with gr.Row():
         lite_btn = gr.Button("Lite")
@@ -31,27 +42,63 @@ with gr.Blocks() as demo:
         show_rerank_btn = gr.Button("Show Top X (LLM Reranked)")
 
     gallery = gr.Gallery(label="Search Results", columns=4, height="auto")
+    # Photo IDs currently in the gallery, and the one the user clicked
+    shown_ids = gr.State([])
+    selected_photo = gr.State(None)
+
+    with gr.Row():
+        more_like_this_btn = gr.Button("More like this (select a photo above)")
+        image_query = gr.Image(type="pil", label="Search by image")
+        image_search_btn = gr.Button("Search by image")
 
     # Button logic
     def set_mode(mode):
         return gr.update(value=mode)
 
-    def run_search(query_input,mode,num_images_search):
+    def load_engine(mode):
         file_path = "data"
         # mode = "lite"
         feature_file = f"{file_path}/{mode}/features/features.npy"
         if not Path(feature_file).exists():
-            photo_metadata = download_data(version="lite", data_path="data", threads_count=16)
-            photo_ids_file, photo_features_file = process_data(photo_metadata, file_path, version="lite", batch_size=16)
+            photo_ids_file, photo_features_file = pipelined_ingest(file_path, version="lite", batch_size=16, threads_count=16)
         else:
             photo_ids_file = "data/lite/features/photo_ids.csv"
             photo_features_file = "data/lite/features/features.npy"
-        best_photo_ids_raw = image_search(photo_ids_file, photo_features_file, query_input, num_images_search)
-        image_paths = []
-        for i, photo_id in enumerate(best_photo_ids_raw):
-            photo_image_path = f"{file_path}/{mode}/photos/{photo_id}.jpg"
-            image_paths.append(Image.open(photo_image_path))
-        return image_paths,best_photo_ids_raw # update both state and top 10 display
+        return get_search_engine(photo_ids_file, photo_features_file)
+
+    def run_search(query_input,mode,num_images_search,filter_input="",search_type="CLIP"):
+        file_path = "data"
+        engine = load_engine(mode)
+        # Only the photos matching the metadata filter are scored
+        filter_expression = filter_input.strip() or None
+        if search_type == "Hybrid":
+            best_photo_ids_raw = engine.hybrid_search(query_input, int(num_images_search), filter_expression)
+        elif search_type == "Keywords":
+            best_photo_ids_raw = engine.lexical_search(query_input, int(num_images_search), filter_expression)
+        else:
+            # Concurrent users' queries are answered together, in one batched encode and scoring pass
+            scheduler = get_scheduler(engine, SCHEDULER_MAX_BATCH_SIZE, SCHEDULER_MAX_WAIT)
+            best_photo_ids_raw = scheduler.search(query_input, int(num_images_search), filter_expression)
+        # Thumbnail paths, the gallery loads them itself
+        image_paths = gallery_items(file_path, mode, best_photo_ids_raw)
+        return image_paths,best_photo_ids_raw,best_photo_ids_raw # update both state and top 10 display
+
+    def select_photo(shown_ids, evt: gr.SelectData):
+        return shown_ids[evt.index]
+
+    def run_more_like_this(selected_photo,mode,num_images_search,filter_input=""):
+        if selected_photo is None:
+            raise gr.Error("Select a photo in the results first")
+        # Read from the precomputed neighbour graph when it was built, a scan otherwise
+        photo_ids = load_engine(mode).more_like_this(selected_photo, int(num_images_search),
+                                                     filter_input.strip() or None)
+        return gallery_items("data", mode, photo_ids), photo_ids
+
+    def run_image_search(image,mode,num_images_search,filter_input=""):
+        if image is None:
+            raise gr.Error("Upload an image first")
+        photo_ids = load_engine(mode).search_by_image(image, int(num_images_search), filter_input.strip() or None)
+        return gallery_items("data", mode, photo_ids), photo_ids
 
     def show_search(images):
         return images
@@ -59,12 +106,7 @@ with gr.Blocks() as demo:
     def show_rerank(best_photo_ids_raw, version, query_input,num_images_rerank):
         file_path = "data"
         image_ids = gemini_rank(best_photo_ids_raw, file_path, version, query_input, num_images_rerank)
-        result = []
-        for i, image_id in enumerate(image_ids):
-            photo_id = best_photo_ids_raw[image_id - 1]
-            photo_image_path = f"{file_path}/{version}/photos/{photo_id}.jpg"
-            result.append(Image.open(photo_image_path))
-        return result
+        return gallery_items(file_path, version, [best_photo_ids_raw[image_id - 1] for image_id in image_ids])
 
 
     def set_mode_lite():
@@ -79,13 +121,20 @@ with gr.Blocks() as demo:
     big_btn.click(fn=set_mode_big, inputs=[], outputs=search_mode)
 
     # Run search when either mode is selected and query entered
-    lite_btn.click(fn=run_search, inputs=[query_input, search_mode], outputs=[search_results, gallery])
-    big_btn.click(fn=run_search, inputs=[query_input, search_mode], outputs=[search_results, gallery])
+    lite_btn.click(fn=run_search, inputs=[query_input, search_mode, num_images_search, filter_input, search_type], outputs=[gallery, search_results, shown_ids])
+    big_btn.click(fn=run_search, inputs=[query_input, search_mode, num_images_search, filter_input, search_type], outputs=[gallery, search_results, shown_ids])
+
+    # Related photos of the clicked result, or of an uploaded image
+    gallery.select(fn=select_photo, inputs=shown_ids, outputs=selected_photo)
+    more_like_this_btn.click(fn=run_more_like_this, inputs=[selected_photo, search_mode, num_images_search, filter_input],
+                             outputs=[gallery, shown_ids])
+    image_search_btn.click(fn=run_image_search, inputs=[image_query, search_mode, num_images_search, filter_input],
+                           outputs=[gallery, shown_ids])
 
     show_search_btn.click(fn=show_search, inputs=[search_results, query_input], outputs=gallery)
     show_rerank_btn.click(fn=show_rerank, inputs=[search_results, query_input], outputs=gallery)
 
-demo.launch()
+demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT).launch()
     # file_path = "data"
     # version = "lite"
     # feature_file = f"{file_path}/{version}/features/features.npy"